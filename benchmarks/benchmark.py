@@ -0,0 +1,254 @@
+"""Benchmarks of the typical workload of a single atom: operator
+construction, crystal field, diagonalization and observables, for
+J = 1/2 ... 8 in double precision (NumPy backend) and for several
+mpmath working precisions.
+
+Every result has the best time of a few repetitions and, for the
+diagonalization, the accuracy of the energies and <Jz> against a
+reference computed at a much higher precision.
+
+Usage (from the repository root):
+
+    python benchmarks/benchmark.py                   # full suite
+    python benchmarks/benchmark.py --J 4 8 --dps 50  # a subset
+    python benchmarks/benchmark.py --save baseline   # results/baseline.json
+    python benchmarks/benchmark.py --compare baseline
+
+With --compare, the timings are printed relative to the stored results
+and the cases that got slower (or less accurate) are marked."""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+import mpmath
+from mpmath import mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pyatoms.core import StevensOperators as StOp  # noqa: E402
+from pyatoms.J.SingleAtom import SingleAtom  # noqa: E402
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+CASES = ['O', 'CrystalField._build', 'SingleAtom', 'QuantumSystem._build',
+         'spectrum', 'transitions', 'J_transitions', 'expectBolzmann']
+
+
+def timeit(f, mintime=0.2, repeat=3):
+    """Best time of f() out of at least *repeat* calls, and of as many
+       as fit into *mintime* seconds."""
+    best = float('inf')
+    start = time.perf_counter()
+    count = 0
+    while count < repeat or time.perf_counter() - start < mintime:
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t)
+        count += 1
+    return best
+
+
+def coefficients(atom, seed):
+    """Reproducible crystal field coefficients, decreasing with the rank
+       as for the rare earths."""
+    rng = np.random.default_rng(seed)
+    return [float(rng.uniform(-1, 1))*10.0**(1-n) for (n, q) in atom.CF.orders]
+
+
+def makeAtom(J, backend, symmetry, seed=0):
+    atom = SingleAtom(J, 'f', backend=backend)
+    atom.setDiskCache(None)
+    atom.setMemoryCache(0)
+    atom.CF.setSymmetry(symmetry)
+    atom.CF.setCoefficients(coefficients(atom, seed))
+    atom.ZT.setg(1.25)
+    atom.ZT.setBxyz(0.1, 0.05, 1.0)
+    return atom
+
+
+def values(M):
+    """Real parts of the elements of a vector of any backend, as mpf."""
+    return [mp.re(mp.mpmathify(x))
+            for x in np.ravel(np.array(M.tolist(), dtype=object))]
+
+
+def reference(J, symmetry, dps):
+    """Energies and <Jz> of the benchmark atom at *dps* digits."""
+    with mp.workdps(dps):
+        atom = makeAtom(J, 'mpmath', symmetry)
+        atom.makeReady()
+        return values(atom._Es), values(atom._expectJz())
+
+
+def error(atom, ref):
+    """Largest error of the energies (relative to the largest one)
+       and of <Jz> (relative to J), at the current precision."""
+    atom.makeReady()
+    Es, Js = ref
+    scale = max(max(abs(E) for E in Es), 1)
+    return float(max(max(abs(a - b) for (a, b) in zip(values(atom._Es), Es))
+                     / scale,
+                     max(abs(a - b) for (a, b) in zip(values(atom._expectJz()),
+                                                      Js))
+                     / max(atom.J, 1)))
+
+
+def run(J, backend, symmetry, ref, mintime):
+    """Times all the cases for one J and backend (at the current mpmath
+       precision). Returns a dictionary case -> (time, error)."""
+    ranks = [n for n in (2, 4, 6) if n <= 2*J]
+    pairs = [(n, q) for n in ranks for q in range(-n, n+1)]
+
+    def operators():
+        StOp.cache.clear()
+        for (n, q) in pairs:
+            StOp.O(J, n, q, False, backend)
+
+    atom = makeAtom(J, backend, symmetry)
+    atom.makeReady()
+    fields = iter(np.tile([1.0, 1.5], 1 << 20))
+    cfs = iter([coefficients(atom, 1), coefficients(atom, 2)]*(1 << 20))
+
+    def crystalField():
+        atom.CF.setCoefficients(next(cfs))
+        atom.CF.makeReady()
+
+    def build():
+        atom.ZT.setBz(next(fields))
+        atom.makeReady()
+
+    results = {
+        'O': (timeit(operators, mintime), None),
+        'CrystalField._build': (timeit(crystalField, mintime), None),
+        'SingleAtom': (timeit(lambda: makeAtom(J, backend, symmetry),
+                              mintime), None),
+    }
+
+    atom = makeAtom(J, backend, symmetry)
+    atom.makeReady()
+    results['QuantumSystem._build'] = (timeit(build, mintime),
+                                       error(makeAtom(J, backend, symmetry),
+                                             ref))
+
+    atom = makeAtom(J, backend, symmetry)
+    results['spectrum'] = (timeit(lambda: atom.spectrum(atom.Jz), mintime),
+                           None)
+    results['transitions'] = (timeit(lambda: atom.transitions(atom.Jz,
+                                                              atom.Jp),
+                                     mintime), None)
+    results['J_transitions'] = (timeit(atom.J_transitions, mintime), None)
+    results['expectBolzmann'] = (timeit(lambda: atom.expectBolzmann(
+        np.array([1., 2., 5., 10.]), atom.Jz), mintime), None)
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(RESULTS)).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'mpmath': mpmath.__version__,
+            'machine': platform.platform()}
+
+
+def resultsPath(name):
+    if name.endswith('.json') or os.sep in name:
+        return name
+    return os.path.join(RESULTS, name + '.json')
+
+
+def label(r):
+    return (r['case'], r['J'], r['backend'], r['dps'])
+
+
+def report(results, baseline=None, threshold=1.2):
+    old = {}
+    if baseline is not None:
+        old = {label(r): r for r in baseline['results']}
+    print("{:22} {:>4} {:>8} {:>4} {:>11} {:>9} {:>7}".format(
+        'case', 'J', 'backend', 'dps', 'time [s]', 'error',
+        'ratio' if old else ''))
+    for r in results:
+        line = "{:22} {:>4} {:>8} {:>4} {:11.3e} {:>9}".format(
+            r['case'], str(r['J']), r['backend'], r['dps'], r['time'],
+            '' if r['error'] is None else '{:9.1e}'.format(r['error']))
+        b = old.get(label(r))
+        if b is not None:
+            ratio = r['time']/b['time']
+            line += " {:7.2f}".format(ratio)
+            if ratio > threshold:
+                line += "  slower"
+            if r['error'] is not None and b['error'] is not None and \
+                    r['error'] > 10*max(b['error'], 1e-300):
+                line += "  less accurate"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of pyatoms single atom calculations.")
+    parser.add_argument('--J', type=float, nargs='+',
+                        default=[J2/2 for J2 in range(1, 17)])
+    parser.add_argument('--dps', type=int, nargs='+', default=[15, 50, 200],
+                        help="mpmath precisions (decimal digits)")
+    parser.add_argument('--backend', nargs='+', default=['numpy', 'mpmath'],
+                        choices=['numpy', 'mpmath'])
+    parser.add_argument('--symmetry', default='C3v')
+    parser.add_argument('--case', nargs='+', choices=CASES, default=CASES,
+                        help="cases to report")
+    parser.add_argument('--mintime', type=float, default=0.2,
+                        help="minimal time spent on every case (s)")
+    parser.add_argument('--save', metavar='NAME',
+                        help="store the results (in results/NAME.json)")
+    parser.add_argument('--compare', metavar='NAME',
+                        help="compare with stored results")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(resultsPath(args.compare)) as f:
+            baseline = json.load(f)
+
+    refdps = 2*max(args.dps + [15]) + 20
+    results = []
+    for J in args.J:
+        if J <= 0 or 2*J != int(2*J):
+            parser.error("J must be a positive multiple of 1/2")
+        J = int(J) if J == int(J) else J
+        ref = reference(J, args.symmetry, refdps)
+        runs = [('numpy', 15)] if 'numpy' in args.backend else []
+        if 'mpmath' in args.backend:
+            runs += [('mpmath', dps) for dps in args.dps]
+        for (backend, dps) in runs:
+            with mp.workdps(dps):
+                timings = run(J, backend, args.symmetry, ref, args.mintime)
+            for case in args.case:
+                t, err = timings[case]
+                results.append({'case': case, 'J': J, 'backend': backend,
+                                'dps': dps, 'time': t, 'error': err})
+
+    report(results, baseline)
+
+    if args.save:
+        path = resultsPath(args.save)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'metadata': metadata(), 'symmetry': args.symmetry,
+                       'refdps': refdps, 'results': results}, f, indent=1)
+        print("Results saved to", path)
+
+
+if __name__ == '__main__':
+    main()
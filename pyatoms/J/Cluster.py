@@ -0,0 +1,201 @@
+import numpy as np
+
+from ..core.QuantumSystem import QuantumSystem
+from ..core.SpaceMixer import SpaceMixer
+from ..core.Setup import setupmethod, buildmethod, instrumented
+from ..core.Lanczos import lanczos
+
+from .SingleAtom import SingleAtom
+
+# mu_0/(4 pi)*mu_B^2 in meV*Angstrom^3
+dipolarConstant = 0.053681
+
+
+class Cluster(QuantumSystem):
+    """A Cluster is a group of coupled magnetic atoms (sites), e.g. a dimer
+       of adatoms. Every site is a SingleAtom with its own crystal field
+       and Zeeman term, available at Cl.sites[i].CF and Cl.sites[i].ZT.
+
+       The sites are coupled by exchange (see setExchange()) and dipolar
+       (see setDipolar()) interactions of the form
+           sum_ab T_ab J_i^a J_j^b
+       with Jx = (J+ + J-)/2, Jy = (J+ - J-)/2i.
+
+       The basis is the product of the |Jz> bases of the sites (the last
+       site runs fastest). The Hamiltonian is kept as a lazy sum of
+       Kronecker products (Cl.Hop, see SpaceMixer.KroneckerOperator), and
+       the full matrix Cl.H is only built when needed.
+
+       With the NumPy backend, only the lowest states are computed with
+       a matrix-free block Lanczos solver (see Lanczos.lanczos()) when
+       fewer states than all are requested, e.g. by spectrum(N=...),
+       or by default if *nlowest* is given, and when the Hilbert space
+       is larger than Cl.denseLimit. Otherwise the full matrix is
+       diagonalized. Operators acting on the cluster (Cl.Jx, Cl.Jy,
+       Cl.Jz, siteOperator()) are Kronecker operators with the NumPy
+       backend and full matrices with the mpmath backend."""
+
+    denseLimit = 500
+
+    def __init__(self, sites, parent=None, backend=None, nlowest=None):
+        """Cluster(sites, nlowest=None)
+        *sites* is a list of (J, orbital) pairs, one for each atom."""
+        QuantumSystem.__init__(self, parent, backend)
+
+        self.sites = [SingleAtom(J, orbital, parent=self,
+                                 backend=self.backend)
+                      for (J, orbital) in sites]
+        self.mixer = SpaceMixer()
+        for site in self.sites:
+            self.mixer.addSubspace(site.nstates)
+        self.nstates = self.mixer.size()
+        self.nlowest = nlowest
+        self.couplings = {}
+
+        j = self.backend.scalar(1j)
+        self._J = [[(site.Jp + site.Jm)/2, -j*(site.Jp - site.Jm)/2, site.Jz]
+                   for site in self.sites]
+        self._H = None
+
+    def _operator(self, KO):
+        """Kronecker operator in the representation used for spectrum()
+           and transitions() by the backend."""
+        if self.backend.name == 'numpy':
+            return KO
+        return KO.dense(self.backend)
+
+    def siteOperator(self, i, op):
+        """Cl.siteOperator(i, op)
+        Returns the operator *op* of the site *i* embedded into the
+        Hilbert space of the cluster."""
+        return self._operator(self.mixer.convertFromSubspace(i, op))
+
+    def _total(self, a):
+        KO = self.mixer.convertFromSubspace(0, self._J[0][a])
+        for i in range(1, len(self.sites)):
+            KO = KO + self.mixer.convertFromSubspace(i, self._J[i][a])
+        return self._operator(KO)
+
+    @property
+    def Jx(self):
+        """x component of the total angular momentum."""
+        return self._total(0)
+
+    @property
+    def Jy(self):
+        """y component of the total angular momentum."""
+        return self._total(1)
+
+    @property
+    def Jz(self):
+        """z component of the total angular momentum."""
+        return self._total(2)
+
+    def setBxyz(self, Bx, By, Bz):
+        """Cl.setBxyz(Bx, By, Bz)
+        Sets the same field on all the sites."""
+        for site in self.sites:
+            site.ZT.setBxyz(Bx, By, Bz)
+
+    def _checkPair(self, i, j):
+        if i == j or not (0 <= i < len(self.sites)
+                          and 0 <= j < len(self.sites)):
+            raise ValueError("Invalid pair of sites ({}, {})".format(i, j))
+
+    @setupmethod
+    def setExchange(self, i, j, J):
+        """Cl.setExchange(i, j, J)
+        Sets the exchange coupling between the sites i and j (in meV):
+        a number for the Heisenberg coupling J*Ji.Jj, three numbers for
+        the anisotropic coupling Jx*Jix*Jjx + Jy*Jiy*Jjy + Jz*Jiz*Jjz or
+        a 3x3 matrix T for the general coupling sum_ab T_ab Ji^a Jj^b.
+        Replaces any previous coupling of the pair."""
+        self._checkPair(i, j)
+        T = np.asarray(J, dtype=float)
+        if T.ndim == 0:
+            T = T*np.eye(3)
+        elif T.shape == (3,):
+            T = np.diag(T)
+        elif T.shape != (3, 3):
+            raise ValueError("Wrong shape of the exchange coupling")
+        if i > j:
+            i, j, T = j, i, T.T
+        self.couplings[(i, j)] = T
+
+    def setDipolar(self, i, j, r, g1=2, g2=2):
+        """Cl.setDipolar(i, j, r, g1=2, g2=2)
+        Sets the magnetic dipolar coupling between the sites i and j,
+        with moments -g1*mu_B*Ji and -g2*mu_B*Jj, at the relative
+        position r = (x, y, z) in Angstrom:
+            mu_0/(4 pi) g1 g2 mu_B^2/|r|^3 (Ji.Jj - 3 (Ji.n)(Jj.n))
+        where n = r/|r|. Replaces any previous coupling of the pair,
+        use setExchange() with the sum of both tensors to combine them."""
+        r = np.asarray(r, dtype=float)
+        d = np.sqrt(np.sum(r**2))
+        if r.shape != (3,) or d == 0:
+            raise ValueError("Invalid relative position")
+        n = r/d
+        self.setExchange(i, j, dipolarConstant*g1*g2/d**3 *
+                         (np.eye(3) - 3*np.outer(n, n)))
+
+    def parameters(self):
+        return ('Cluster', tuple(site.parameters() for site in self.sites),
+                tuple(sorted(self.couplings.items())))
+
+    @buildmethod
+    def _buildH(self):
+        for site in self.sites:
+            # through the sites' own build, so that they skip unchanged
+            # parts and keep their H until their parameters change
+            site.makeReady(vectors=False)
+        if not self.changed('setExchange', *self.sites):
+            return  # the full matrix Cl.H is kept as well
+        Hop =self.mixer.convertFromSubspace(0, self.sites[0].H)
+        for i in range(1, len(self.sites)):
+            Hop = Hop + self.mixer.convertFromSubspace(i, self.sites[i].H)
+        for ((i, j), T) in self.couplings.items():
+            for a in range(3):
+                for b in range(3):
+                    if T[a, b] != 0:
+                        Hop = Hop + self.backend.scalar(T[a, b]) * (
+                            self.mixer.convertFromSubspace(i, self._J[i][a]) *
+                            self.mixer.convertFromSubspace(j, self._J[j][b]))
+        self._Hop = Hop
+        self._H = None
+
+    @property
+    def Hop(self):
+        """The Hamiltonian as a Kronecker operator."""
+        if not self.ready:
+            self._buildH()
+        return self._Hop
+
+    @property
+    def H(self):
+        """The Hamiltonian as a full matrix of the backend."""
+        Hop = self.Hop
+        if self._H is None:
+            self._H = Hop.dense(self.backend)
+        return self._H
+
+    def spectrum(self, *ops, N=None):
+        if not ops:
+            ops = (self._operator(self.Hop), )
+        return QuantumSystem.spectrum(self, *ops, N=N)
+
+    def makeReady(self, N=None, vectors=True):
+        if self.nlowest is not None and (N is None or N > self.nlowest):
+            N = self.nlowest
+        QuantumSystem.makeReady(self, N, vectors)
+
+    @instrumented
+    def _diagonalize(self, N, vectors=True):
+        if (self.backend.name != 'numpy' or N >= self.nstates
+                or self.nstates <= self.denseLimit):
+            QuantumSystem._diagonalize(self, N, vectors)
+            return
+
+        Hop = self.Hop
+        self._Es, self._Xs = lanczos(Hop.dot, self.nstates, N)
+        self._Ks = None
+        self._nsolved = self._nvalues = N
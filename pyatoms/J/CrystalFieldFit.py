@@ -0,0 +1,242 @@
+import numpy as np
+
+
+class CrystalFieldFit:
+    """Fits the crystal field coefficients of a SingleAtom (or any
+       system with a crystal field CF) to measured energies.
+
+       The data are energies of levels above the ground state (addLevel())
+       and of transitions between two levels (addTransition()), where
+       levels are the eigenstates ordered by energy (degenerate states
+       count separately), each with a weight (1/sigma^2).
+
+       The fit minimizes the weighted sum of squared residuals with the
+       Levenberg-Marquardt method. The Jacobian is analytic: by the
+       Hellmann-Feynman theorem dE_i/dc_k = <i|O_k|i>, computed from the
+       eigenstates of the current diagonalization and the Stevens
+       operators CF.ops, so every step costs a single diagonalization.
+       The second derivatives (see energyHessian()) can be added to the
+       Gauss-Newton approximation of the Hessian (fit(secondOrder=True)).
+
+       States closer in energy than CFF.degeneracy are treated as
+       degenerate: each gets the mean derivative of its group, i.e. the
+       derivative of the mean energy of the group. This is exact for
+       degeneracies that the crystal field cannot lift (e.g. Kramers
+       doublets or the doublets of the trigonal symmetries)."""
+
+    def __init__(self, atom, orders=None):
+        """CrystalFieldFit(atom, orders=None)
+        Fits the coefficients of *orders* (a list of (n, q), by default
+        all the orders of atom.CF); the others keep their values."""
+        self.atom = atom
+        CF = atom.CF
+        if orders is None:
+            orders = list(CF.orders)
+        for o in orders:
+            if tuple(o) not in CF.orders:
+                raise ValueError(
+                    'Stevens operator {} not corresponding to symmetry'
+                    .format(tuple(o)))
+        self.orders = [tuple(o) for o in orders]
+        self.lower = np.full(len(self.orders), -np.inf)
+        self.upper = np.full(len(self.orders), np.inf)
+        self.degeneracy = 1e-8
+        self._rows = []  # (initial level, final level, energy, weight)
+        self._ops = None
+        self._opsource = None
+
+        self.cost = None
+        self.iterations = 0
+        self.converged = False
+
+    def addLevel(self, i, E, weight=1):
+        """CFF.addLevel(i, E, weight=1)
+        Level *i* (0 is the ground state) is at the energy *E*
+        above the ground state."""
+        self.addTransition(0, i, E, weight)
+
+    def addTransition(self, i, f, E, weight=1):
+        """CFF.addTransition(i, f, E, weight=1)
+        The transition from level *i* to level *f* has the energy
+        E = E_f - E_i."""
+        n = self.atom.nstates
+        if not (0 <= i < n and 0 <= f < n):
+            raise ValueError("No level pair ({}, {})".format(i, f))
+        if weight < 0:
+            raise ValueError("Negative weight")
+        self._rows.append((i, f, E, weight))
+
+    def setBounds(self, n, q, lower=None, upper=None):
+        """CFF.setBounds(n, q, lower=None, upper=None)
+        Restricts the coefficient of O_n^q to [lower, upper]
+        (None for no bound)."""
+        k = self._index(n, q)
+        self.lower[k] = -np.inf if lower is None else lower
+        self.upper[k] = np.inf if upper is None else upper
+
+    def _index(self, n, q):
+        try:
+            return self.orders.index((n, q))
+        except ValueError:
+            raise ValueError('Stevens operator ({}, {}) is not fitted'
+                             .format(n, q))
+
+    @property
+    def coefficients(self):
+        """The current values of the fitted coefficients."""
+        CF = self.atom.CF
+        return np.array([float(np.real(CF.coeff[CF.orders.index(o)]))
+                         for o in self.orders])
+
+    def setCoefficients(self, values):
+        """CFF.setCoefficients(values)
+        Sets the fitted coefficients of the crystal field."""
+        CF = self.atom.CF
+        coeff = list(CF.coeff)
+        for (o, c) in zip(self.orders, values):
+            coeff[CF.orders.index(o)] = float(c)
+        CF.setCoefficients(coeff)
+
+    def _operators(self):
+        """The fitted Stevens operators as a NumPy array (k, n, n)."""
+        CF = self.atom.CF
+        if self._opsource is not CF.ops:
+            backend = self.atom.backend
+            self._ops = np.array([backend.tonumpy(CF.ops[CF.orders.index(o)])
+                                  for o in self.orders])
+            self._opsource = CF.ops
+        return self._ops
+
+    def _groups(self, Es):
+        """Index of the degenerate group of every level."""
+        return np.concatenate([[0], np.cumsum(np.diff(Es) > self.degeneracy)])
+
+    def _matrixElements(self, diagonal):
+        """<i|O_k|j> for all the fitted operators, from the current
+           eigenstates (only <i|O_k|i>, shape (n, k), if *diagonal*)."""
+        X = self.atom.backend.tonumpy(self.atom.Xs)
+        OX = np.einsum('kab,bi->kai', self._operators(), X)
+        if diagonal:
+            return np.einsum('ai,kai->ik', X.conj(), OX).real
+        return np.einsum('aj,kai->kji', X.conj(), OX)
+
+    def energyGradient(self):
+        """CFF.energyGradient()
+        Returns the derivatives dE_i/dc_k of the energies of all the
+        levels with respect to the fitted coefficients (n x k)."""
+        G = self._matrixElements(True)
+        Es = self.atom.Es
+        groups = self._groups(Es)
+        counts = np.bincount(groups)
+        means = np.zeros((len(counts), G.shape[1]))
+        np.add.at(means, groups, G)
+        return (means/counts[:, None])[groups]
+
+    def energyHessian(self):
+        """CFF.energyHessian()
+        Returns the second derivatives d^2E_i/dc_k dc_l (n x k x k)
+        from second order perturbation theory,
+            2 Re sum_j <i|O_k|j><j|O_l|i>/(E_i - E_j),
+        with the sum over the levels j outside the degenerate group
+        of i."""
+        M = self._matrixElements(False)
+        Es = self.atom.Es
+        groups = self._groups(Es)
+        dE = Es[:, None] - Es[None, :]
+        D = np.where(groups[:, None] == groups[None, :], 0,
+                     1/np.where(dE == 0, 1, dE))
+        return 2*np.einsum('kij,lji,ij->ikl', M, M, D).real
+
+    def _design(self):
+        """The data as arrays (initial, final, energy, sqrt(weight))."""
+        if not self._rows:
+            raise ValueError("No data to fit")
+        i, f, E, w = (np.array(c) for c in zip(*self._rows))
+        return i.astype(int), f.astype(int), E.astype(float), np.sqrt(w)
+
+    def residuals(self):
+        """CFF.residuals()
+        Returns the weighted residuals sqrt(w)*(E_f - E_i - E) of all
+        the data for the current coefficients."""
+        i, f, E, s = self._design()
+        Es = self.atom.Es
+        return s*(Es[f] - Es[i] - E)
+
+    def jacobian(self):
+        """CFF.jacobian()
+        Returns the derivatives of the residuals with respect to the
+        fitted coefficients."""
+        i, f, E, s = self._design()
+        G = self.energyGradient()
+        return s[:, None]*(G[f] - G[i])
+
+    def _evaluate(self, c, secondOrder):
+        self.setCoefficients(c)
+        self.atom.makeReady()  # energies and eigenstates at once
+        r = self.residuals()
+        J = self.jacobian()
+        A = J.T @ J
+        if secondOrder:
+            i, f, E, s = self._design()
+            H = self.energyHessian()
+            A = A + np.einsum('m,mkl->kl', r*s, H[f] - H[i])
+        return r, J.T @ r, A
+
+    def fit(self, maxiter=100, tol=1e-10, secondOrder=False):
+        """CFF.fit(maxiter=100, tol=1e-10, secondOrder=False)
+        Fits the coefficients, starting from their current values, and
+        leaves the best ones set in the crystal field. Stops when the
+        relative decrease of the cost (the weighted sum of squared
+        residuals) or the relative step is below *tol*.
+
+        Coefficients at a bound that the gradient pushes outward are
+        held fixed for the step, which solves the damped system for the
+        free ones only; free ones leaving the bounds are projected back
+        onto them. With
+        *secondOrder*, the second derivatives of the energies are added
+        to the Gauss-Newton Hessian J^T J, which speeds up fits with
+        large residuals.
+
+        Returns the fitted coefficients, the final cost is CFF.cost.
+        CFF.converged is False if the fit stopped without meeting *tol*."""
+        c = np.clip(self.coefficients, self.lower, self.upper)
+        r, g, A = self._evaluate(c, secondOrder)
+        cost = r @ r
+        damping = 1e-3
+        self.converged = False
+
+        for self.iterations in range(1, maxiter+1):
+            free = ~((c <= self.lower) & (g > 0) | (c >= self.upper) & (g < 0))
+            if not free.any():
+                self.converged = True  # every coefficient pinned at a bound
+                break
+            scale = np.diag(A)[free]
+            scale = np.where(scale > 0, scale, 1)
+            step = np.zeros_like(c)
+            try:
+                step[free] = np.linalg.solve(
+                    A[np.ix_(free, free)] + damping*np.diag(scale), -g[free])
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            trial = np.clip(c + step, self.lower, self.upper)
+            rt, gt, At = self._evaluate(trial, secondOrder)
+            trialcost = rt @ rt
+
+            if trialcost <= cost:
+                small = (cost - trialcost <= tol*cost or
+                         np.all(np.abs(trial - c) <=
+                                tol*(np.abs(c) + tol)))
+                c, r, g, A, cost = trial, rt, gt, At, trialcost
+                damping = max(damping/10, 1e-12)
+                if small:
+                    self.converged = True
+                    break
+            else:
+                damping *= 10
+                if damping > 1e12:
+                    break  # stalled, no descent left
+
+        self.setCoefficients(c)
+        self.cost = cost
+        return c
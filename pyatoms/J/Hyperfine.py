@@ -0,0 +1,69 @@
+from ..core.Setup import SetupClass, setupmethod
+from ..core.LinearCombination import LinearCombination
+
+# nuclear magneton in meV/T
+muN = 3.15245125844e-5
+
+
+class HyperfineTerm(SetupClass):
+    """ HyperfineTerm contains the terms of a nuclear spin I:
+
+    the hyperfine coupling to the electronic J
+        Apar Jz Iz + Aperp (Jx Ix + Jy Iy),
+    the nuclear quadrupole interaction
+        P (Iz^2 - I(I+1)/3 + eta/3 (Ix^2 - Iy^2)),
+    and the conversion factor of the nuclear Zeeman term
+        HF.nuclear*B.I,
+    which uses the field of the parent's ZeemanTerm (see setgN()).
+
+    All the energies are in meV. The matrix HF.H (without the nuclear
+    Zeeman term) acts on the product space J x I of the parent.
+    """
+    def __init__(self, parent=None):
+        SetupClass.__init__(self, parent)
+
+        self.Apar = 0
+        self.Aperp = 0
+        self.P = 0
+        self.eta = 0
+        self.nuclear = 0
+        self._sum = None
+
+    @setupmethod
+    def setA(self, Apar, Aperp=None):
+        """HF.setA(Apar, Aperp=None)
+        Sets the hyperfine coupling constants, by default isotropic."""
+        self.Apar = Apar
+        self.Aperp = Apar if Aperp is None else Aperp
+
+    @setupmethod
+    def setQuadrupole(self, P, eta=0):
+        """HF.setQuadrupole(P, eta=0)
+        Sets the quadrupole coupling P and the asymmetry parameter eta."""
+        self.P = P
+        self.eta = eta
+
+    @setupmethod
+    def setNuclearFactor(self, f):
+        """The nuclear Zeeman term is $f\vec{B}\vec{I}$"""
+        self.nuclear = f
+
+    @setupmethod
+    def setgN(self, gN):
+        """The nuclear Zeeman term is $-g_N\mju_N\vec{B}\vec{I}$, with B
+           in Tesla (use together with ZT.setg())."""
+        self.setNuclearFactor(-muN*gN)
+
+    def parameters(self):
+        return ('HyperfineTerm', self.Apar, self.Aperp, self.P, self.eta,
+                self.nuclear)
+
+    def _build(self):
+        '''Construct the matrix, kept as a linear combination of the
+           coupling operators (see LinearCombination).'''
+        if self._sum is None:
+            P = self.parent
+            self._sum = LinearCombination(P.backend, P.nstates,
+                                          P.hyperfineOperators)
+        self.H = self._sum.update([self.Apar, self.Aperp,
+                                   self.P, self.P*self.eta/3])
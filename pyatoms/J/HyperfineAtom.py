@@ -0,0 +1,117 @@
+from math import gcd
+
+from ..core.CrystalField import CrystalField
+from ..core.SpaceMixer import SpaceMixer
+from ..core.Setup import buildmethod
+from ..core.LinearCombination import LinearCombination
+from ..core.AngularMomentum import Jz, Jplus, Jminus, J2, Jrange
+
+from .MagneticField import ZeemanTerm
+from .Hyperfine import HyperfineTerm
+from .JSystem import JSystem
+
+
+class HyperfineAtom(JSystem):
+    """A HyperfineAtom is a SingleAtom with a nuclear spin I.
+
+       The basis is |Jz, Iz> (Iz runs fastest), and all the operators,
+       e.g. HA.Jz or the nuclear HA.Iz, HA.Ip, HA.Im and HA.Fz = Jz + Iz,
+       act on the whole product space of (2J+1)*(2I+1) states. The
+       crystal field (HA.CF) and the Zeeman term (HA.ZT) act on J only,
+       the hyperfine, quadrupole and nuclear Zeeman terms are set up
+       in HA.HF (see HyperfineTerm).
+
+       Without transverse fields, the Hamiltonian only couples states
+       whose Fz differs by a multiple of the q of the active Stevens
+       operators (and of 2 for a non-axial quadrupole term), so it is
+       diagonalized in blocks labeled by Fz (modulo that multiple),
+       see QS.Ks."""
+
+    def __init__(self, J, orbital, I, parent=None, backend=None):
+
+        JSystem.__init__(self, J, parent, backend)
+
+        self.I = I
+        self.mixer = SpaceMixer()
+        self.mixer.addSubspace(int(2*J+1))
+        self.mixer.addSubspace(int(2*I+1))
+        self.nstates = self.mixer.size()
+
+        def embed(ssi, op):
+            return self.mixer.convertFromSubspace(ssi, op)
+
+        jz, jp, jm = (embed(0, M(J)) for M in (Jz, Jplus, Jminus))
+        iz, ip, im = (embed(1, M(I)) for M in (Jz, Jplus, Jminus))
+
+        self.J2 = embed(0, J2(J)).dense(self.backend)
+        self.Jz, self.Jp, self.Jm = (M.dense(self.backend)
+                                     for M in (jz, jp, jm))
+        self.Iz, self.Ip, self.Im = (M.dense(self.backend)
+                                     for M in (iz, ip, im))
+        self.Fz = (jz + iz).dense(self.backend)
+
+        self.hyperfineOperators = [
+            (jz*iz).dense(self.backend),
+            ((jp*im + jm*ip)/2).dense(self.backend),
+            (iz*iz - I*(I+1)/3*self.mixer.identity()).dense(self.backend),
+            ((ip*ip + im*im)/2).dense(self.backend)]
+
+        self.CF = CrystalField(J, orb=orbital, parent=self,
+                               backend=self.backend)
+        self.ZT = ZeemanTerm(self)
+        self.HF = HyperfineTerm(self)
+
+        self._nuclear = LinearCombination(
+            self.backend, self.nstates,
+            [self.Iz, (self.Ip + self.Im)/2,
+             self.backend.scalar(1j)*(self.Ip - self.Im)/2])
+
+    @buildmethod
+    def _buildH(self):
+        self.CF.makeReady()
+        self.ZT.makeReady()
+        self.HF.makeReady()
+        if self.changed(self.CF):
+            self._HCF = (self.mixer.convertFromSubspace(0, self.CF.CF)
+                         .dense(self.backend))
+        elif not self.changed(self.ZT, self.HF):
+            return
+        f = self.HF.nuclear
+        H = (self._HCF + self.ZT.B + self.HF.H
+             + self._nuclear.update([f*self.ZT.Bz, f*self.ZT.Bx,
+                                     f*self.ZT.By]))
+        self.real = (self.CF.real and self.ZT.real
+                     and f*self.ZT.By == 0)
+        self._H = self.backend.real(H) if self.real else H
+
+    def parameters(self):
+        return ('HyperfineAtom', self.J, self.I, self.CF.parameters(),
+                self.ZT.parameters(), self.HF.parameters())
+
+    def _blocks(self):
+        """The crystal field couples Jz values that differ by a multiple
+           of the q of the active Stevens operators, the hyperfine
+           coupling conserves Fz = Jz + Iz, and the quadrupole term
+           changes Iz by 2 if eta != 0. The Hamiltonian then splits into
+           blocks labeled by Fz modulo the greatest common divisor of
+           these changes (or by Fz itself), unless there is a transverse
+           field."""
+        if (self.ZT.conv != 0 or self.HF.nuclear != 0) and \
+                (self.ZT.Bx != 0 or self.ZT.By != 0):
+            return None
+
+        n = 0
+        for ((nn, q), c) in zip(self.CF.orders, self.CF.coeff):
+            if c != 0:
+                n = gcd(n, abs(int(q)))
+        if self.HF.P != 0 and self.HF.eta != 0:
+            n = gcd(n, 2)
+        if n == 1:
+            return None
+
+        Fs = [mj + mi for mj in Jrange(self.J) for mi in Jrange(self.I)]
+        labels = sorted(set(F if n == 0 else F % n for F in Fs))
+        blocks = [[i for (i, F) in enumerate(Fs)
+                   if (F if n == 0 else F % n) == label]
+                  for label in labels]
+        return labels, blocks
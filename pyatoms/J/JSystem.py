@@ -1,44 +1,70 @@
-import numpy as np
-from mpmath import mp
 from ..core.AngularMomentum import J2, Jz, Jplus, Jminus  # , Jrange #, J2range
 from ..core.Setup import resultmethod
-from ..core.QuantumSystem import QuantumSystem, get_diag
+from ..core.QuantumSystem import QuantumSystem
+from ..core.Relaxation import Relaxation
 
 
 class JSystem(QuantumSystem):
 
-    def __init__(self, J, parent=None):
+    def __init__(self, J, parent=None, backend=None):
 
-        QuantumSystem.__init__(self, parent)
+        QuantumSystem.__init__(self, parent, backend)
 
         self.J = J
-        self.J2 = J2(self.J)
-        self.Jz = Jz(self.J)
-        self.Jp = Jplus(self.J)
-        self.Jm = Jminus(self.J)
+        self.J2 = self.backend.matrix(J2(self.J))
+        self.Jz = self.backend.matrix(Jz(self.J))
+        self.Jp = self.backend.matrix(Jplus(self.J))
+        self.Jm = self.backend.matrix(Jminus(self.J))
 
         self.nstates = int(2*J+1)
 
     def _build(self):
         QuantumSystem._build(self)
-        self._Js = get_diag(self._Xs.H*self.Jz*self._Xs)
+        self._Js = None if self._entry is None else self._entry.get('Js')
+        self._JsView = None
 
     @property
     @resultmethod
     def Js(self):
-        return np.real(np.array(self._Js.tolist(), dtype=complex).flatten())
+        """<Jz> of the eigenstates as a (read-only) NumPy array,
+        computed on first use."""
+        if self._JsView is None:
+            self._JsView = self._view(self._expectJz())
+        return self._JsView
+
+    def _expectJz(self):
+        """<Jz> of the eigenstates in the backend representation."""
+        if self._Js is None:
+            self._Js = self.backend.expect(self.Jz, self._Xs)
+            if self._entry is not None:
+                self._entry['Js'] = self._Js
+        return self._Js
+
+    def _J_probabilities(self, JZ, JP, backend):
+        """Combines the transition matrices of Jz and J+ into
+           the transition probabilities (see J_transitions()).
+
+           The J- matrix elements are not needed, as
+           <f|J-|i> is the complex conjugate of <i|J+|f>."""
+        abs2 = backend.abs2
+        P = abs2(JP)
+        return (2*abs2(JZ) + P + backend.transpose(P))/2/self.J/(self.J+1)
 
-    @resultmethod
     def J_transitions(self, N=None):
-        def multiply(m1,m2):
-            return mp.matrix(np.asarray(m1.tolist())*np.asarray(m2.tolist()))
+        JZ, JP = self.transitions(self.Jz, self.Jp, N=N)
+        return self._J_probabilities(JZ, JP, self.backend)
 
-        JZ, JP, JM = self.transitions(self.Jz, self.Jp, self.Jm)
+    def relaxation(self, T, electron=0, phonon=0, N=None):
+        """JS.relaxation(T, electron=0, phonon=0, N=None)
+        Returns the Relaxation of the lowest N levels (by default all)
+        at the temperature(s) *T*, with transition rates proportional
+        to the J transition probabilities (see J_transitions()).
 
+        For maps over the field, pass the energies and transition
+        probabilities of SA.sweep() to Relaxation directly, which shares
+        one diagonalization per field between all the temperatures."""
         if N is None or N > self.nstates:
             N = self.nstates
-
-        return ((2*multiply(JZ,JZ.conjugate()) +
-                multiply(JP,JP.conjugate()) +
-                multiply(JM,JM.conjugate()))/2/self.J/(self.J+1))[:N, :N]
-
+        P = self.J_transitions(N=N)
+        # the energies of the same (partial) diagonalization
+        return Relaxation(self._view(self._Es)[:N], P, T, electron, phonon)
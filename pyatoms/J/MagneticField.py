@@ -1,7 +1,7 @@
 import numpy as np
-from mpmath import mp
 from ..core.Setup import setupmethod
 from ..core.MagneticField import ZeemanTerm as ZeemanTermCore
+from ..core.LinearCombination import LinearCombination
 
 
 class ZeemanTerm(ZeemanTermCore):
@@ -22,6 +22,11 @@ class ZeemanTerm(ZeemanTermCore):
     by using setBFactor() to set an arbitrary conversion factor or
     setg() to set the Lande g-factor and convert magnetic field to Tesla.
     """
+    def __init__(self, parent=None):
+        ZeemanTermCore.__init__(self, parent)
+        self._sum = None
+        self.real = True
+
     @setupmethod
     def setg(self, *args):
         """The Zeeman term is $g\mju_B\vec{B}\vec{J}$,
@@ -44,14 +49,18 @@ class ZeemanTerm(ZeemanTermCore):
 
     def _build(self):
         '''Construct the operator matrix. If the y component of the field is
-           zero, the matrix will be real, otherwise, it will be complex.'''
+           zero, the matrix will be real (ZT.real), otherwise, it will
+           be complex.
 
-        if self.By == 0:
-            self.B = self.parent.Jz*self.Bz \
-                + (self.parent.Jp + self.parent.Jm)*self.Bx/2
-        else:
-            Bplus = mp.mpc(complex(self.Bx, self.By))
-            Bminus = mp.mpc(complex(self.Bx, -self.By))
-            self.B = self.parent.Jz*self.Bz \
-                + (Bplus*self.parent.Jp + Bminus*self.parent.Jm)/2
-        self.B *= self.conv
+           The matrix is kept as a linear combination of the (cached)
+           Jz, (J+ + J-)/2 and i(J+ - J-)/2 matrices, so a field change
+           only adds the change of the corresponding terms.'''
+        if self._sum is None:
+            P = self.parent
+            self._sum = LinearCombination(
+                P.backend, P.nstates,
+                [P.Jz, (P.Jp + P.Jm)/2, P.backend.scalar(1j)*(P.Jp - P.Jm)/2])
+        self.real = self.conv*self.By == 0
+        self.B = self._sum.update([self.conv*self.Bz,
+                                   self.conv*self.Bx,
+                                   self.conv*self.By])
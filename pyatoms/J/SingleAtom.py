@@ -1,26 +1,384 @@
 # Numpy module
 import numpy as np
+from math import gcd
 
 from ..core.CrystalField import CrystalField
 from ..core.Setup import buildmethod
+from ..core.Backend import getBackend
+from ..core.AngularMomentum import Jrange
+from ..core.Thermodynamics import Thermodynamics
 
 from .MagneticField import ZeemanTerm
 from .JSystem import JSystem
 
 
 class SingleAtom(JSystem):
-    def __init__(self, J, orbital, parent=None):
+    def __init__(self, J, orbital, parent=None, backend=None):
 
-        JSystem.__init__(self, J, parent)
+        JSystem.__init__(self, J, parent, backend)
 
-        self.CF = CrystalField(J, orb=orbital, parent=self)
+        self.CF = CrystalField(J, orb=orbital, parent=self,
+                               backend=self.backend)
         self.ZT = ZeemanTerm(self)
 
     @buildmethod
     def _buildH(self):
         self.CF.makeReady()
         self.ZT.makeReady()
-        self._H = self.CF.CF + self.ZT.B
+        if not self.changed(self.CF, self.ZT):
+            return  # e.g. only more eigenstates are wanted
+        H = self.CF.CF + self.ZT.B
+        self.real = self.CF.real and self.ZT.real
+        self._H = self.backend.real(H) if self.real else H
+
+    def parameters(self):
+        return ('SingleAtom', self.J, self.CF.parameters(),
+                self.ZT.parameters())
+
+    def _blocks(self):
+        """The crystal field only couples Jz values that differ by
+           a multiple of some q of the active Stevens operators (a multiple
+           of n for Cn and Cnv symmetries), and a field along z does not
+           couple any. The Hamiltonian then splits into blocks labeled
+           by Jz modulo the greatest common divisor of these q."""
+        if self.ZT.conv != 0 and (self.ZT.Bx != 0 or self.ZT.By != 0):
+            return None
+
+        n = 0
+        for ((nn, q), c) in zip(self.CF.orders, self.CF.coeff):
+            if c != 0:
+                n = gcd(n, abs(int(q)))
+        if n == 1:
+            return None
+
+        ms = Jrange(self.J)
+        if n == 0 or n >= self.nstates:
+            return ms, [[i] for i in range(self.nstates)]
+        return ([ms[i] % n for i in range(n)],
+                [list(range(i, self.nstates, n)) for i in range(n)])
+
+    def _direction(self, direction):
+        """Unit vector along *direction*, by default along the field
+           (or z in zero field)."""
+        if direction is None:
+            direction = (self.ZT.Bx, self.ZT.By, self.ZT.Bz)
+        n = np.asarray(direction, dtype=float)
+        norm = np.sqrt(np.sum(n**2, axis=-1, keepdims=True))
+        return np.where(norm == 0, (0, 0, 1), n/np.where(norm == 0, 1, norm))
+
+    def moment(self, direction=None):
+        """SA.moment(direction=None)
+        Returns the magnetic moment operator -dH/dB along *direction*
+        (a vector, by default along the field), in the units of
+        SA.ZT (e.g. meV/T after ZT.setg())."""
+        nx, ny, nz = (self.backend.scalar(-self.ZT.conv*c)
+                      for c in self._direction(direction))
+        M = nz*self.Jz + nx*(self.Jp + self.Jm)/2
+        if ny != 0:
+            M = M + ny*self.backend.scalar(1j)*(self.Jp - self.Jm)/2
+        return M
+
+    def magnetization(self, T, direction=None):
+        """SA.magnetization(T, direction=None)
+        Thermal average of the magnetic moment along *direction*
+        (by default along the field) at the temperature(s) *T*."""
+        M, = self.spectrum(self.moment(direction))
+        return self.thermodynamics(T).average(
+            np.real(self.backend.tonumpy(M)).flatten())
+
+    def susceptibility(self, T, direction=None):
+        """SA.susceptibility(T, direction=None)
+        Isothermal magnetic susceptibility along *direction* (by default
+        along the field) at the temperature(s) *T*, including the
+        Van Vleck term, see Thermodynamics.susceptibility()."""
+        M, = self.transitions(self.moment(direction))
+        return self.thermodynamics(T).susceptibility(
+            self.backend.tonumpy(M))
+
+    def _sweepPoints(self, Bx, By, Bz, coefficients, chunksize):
+        """Broadcasts the sweep parameters (see sweep()) and returns
+           their common shape S, the number of points and a generator of
+           (slice, (Bx, By, Bz), H) for consecutive chunks of points,
+           where the field components have shape (chunk, 1, 1) and
+           H is the stack of double precision Hamiltonians."""
+        npb = getBackend('numpy')
+
+        orders = list(coefficients)
+        for o in orders:
+            if o not in self.CF.orders:
+                raise ValueError(
+                    'Stevens operator not corresponding to symmetry')
+
+        values = [self.ZT.Bx if Bx is None else Bx,
+                  self.ZT.By if By is None else By,
+                  self.ZT.Bz if Bz is None else Bz]
+        values += [coefficients[o] for o in orders]
+        values = np.broadcast_arrays(*[np.asarray(v, dtype=float)
+                                       for v in values])
+        shape = values[0].shape
+        values = [v.ravel()[:, None, None] for v in values]
+        npoints = values[0].shape[0]
+
+        H0 = npb.zeros(self.nstates)
+        ops = []
+        for o, op, c in zip(self.CF.orders, self.CF.ops, self.CF.coeff):
+            if o in orders:
+                ops.append(npb.matrix(op))
+            elif c != 0:
+                H0 = H0 + npb.matrix(op)*npb.scalar(c)
+
+        Jz, Jp, Jm = (npb.matrix(M) for M in (self.Jz, self.Jp, self.Jm))
+        conv = npb.scalar(self.ZT.conv)
+
+        def chunks():
+            for start in range(0, npoints, chunksize):
+                chunk = slice(start, start+chunksize)
+                Bxs, Bys, Bzs = (v[chunk] for v in values[:3])
+
+                H = H0 + conv*(Bzs*Jz + Bxs*(Jp + Jm)/2)
+                if np.any(Bys):
+                    H = H + conv*1j*Bys*(Jp - Jm)/2
+                for c, op in zip(values[3:], ops):
+                    if np.any(c[chunk]):
+                        H = H + c[chunk]*op
+                yield chunk, (Bxs, Bys, Bzs), H
+
+        return shape, npoints, chunks()
+
+    def sweep(self, Bx=None, By=None, Bz=None, coefficients={}, N=None,
+              chunksize=1024):
+        """SA.sweep(Bx=None, By=None, Bz=None, coefficients={}, N=None)
+        Calculates the energies, <Jz> and J transition probabilities
+        for a whole set of parameters at once.
+
+        The field components (in the units of SA.ZT) and the CF
+        coefficients (a dictionary {(n, q): values}) can be scalars or
+        arrays, that are broadcast against each other to a common shape S.
+        Parameters that are not given are taken from the current state
+        of SA.ZT and SA.CF, which is not modified.
+
+        The Hamiltonians are assembled and diagonalized in stacks of
+        *chunksize* matrices, always in double precision with NumPy.
+
+        Returns a tuple of NumPy arrays (Es, Js, Ps) with shapes S+(N,),
+        S+(N,) and S+(N, N), where Ps[..., f, i] is the transition
+        probability from state i to state f (see J_transitions()).
+        By default N is the number of states."""
+        npb = getBackend('numpy')
+
+        if N is None or N > self.nstates:
+            N = self.nstates
+
+        shape, npoints, chunks = self._sweepPoints(Bx, By, Bz, coefficients,
+                                                   chunksize)
+        Jz, Jp = npb.matrix(self.Jz), npb.matrix(self.Jp)
+
+        Es = np.empty((npoints, N))
+        Js = np.empty((npoints, N))
+        Ps = np.empty((npoints, N, N))
+
+        for chunk, B, H in chunks:
+            E, X = npb.eigh(H)
+            X = X[..., :N]
+
+            Es[chunk] = E[:, :N]
+            Js[chunk] = np.real(npb.expect(Jz, X))
+            Ps[chunk] = self._J_probabilities(
+                npb.transform(Jz, X), npb.transform(Jp, X), npb)
+
+        return (Es.reshape(shape + (N,)),
+                Js.reshape(shape + (N,)),
+                Ps.reshape(shape + (N, N)))
+
+    def thermalSweep(self, T, Bx=None, By=None, Bz=None, coefficients={},
+                     direction=None, chunksize=256):
+        """SA.thermalSweep(T, Bx=None, By=None, Bz=None, coefficients={},
+                           direction=None)
+        Calculates the thermodynamics for a whole set of parameters
+        (broadcast to a common shape S, see sweep()) and every
+        temperature in *T*, diagonalizing every point only once.
+
+        Returns a tuple (TH, M, chi) of the Thermodynamics of all the
+        points (TH.Z, TH.heatCapacity, ... have shape S+T.shape) and
+        the magnetization and susceptibility along *direction* (by default
+        along the field of every point) with the same shape."""
+        npb = getBackend('numpy')
+
+        shape, npoints, chunks = self._sweepPoints(Bx, By, Bz, coefficients,
+                                                   chunksize)
+        Jz, Jp, Jm = (npb.matrix(M) for M in (self.Jz, self.Jp, self.Jm))
+        T = np.asarray(T, dtype=float)
+
+        Es = np.empty((npoints, self.nstates))
+        M = np.empty((npoints,) + T.shape)
+        chi = np.empty((npoints,) + T.shape)
+
+        for chunk, B, H in chunks:
+            E, X = npb.eigh(H)
+            if direction is None:
+                n = self._direction(np.concatenate(B, axis=-1))[:, 0, :]
+            else:
+                n = np.broadcast_to(self._direction(direction), (len(E), 3))
+            n = -self.ZT.conv*n.reshape(-1, 3, 1, 1)
+            moment = n[:, 2]*Jz + n[:, 0]*(Jp + Jm)/2
+            if np.any(n[:, 1]):
+                moment = moment + n[:, 1]*1j*(Jp - Jm)/2
+            moment = npb.transform(moment, X)
+
+            TH = Thermodynamics(E, T)
+            Es[chunk] = E
+            M[chunk] = TH.average(np.real(npb.diagonal(moment)))
+            chi[chunk] = TH.susceptibility(moment)
+
+        return (Thermodynamics(Es.reshape(shape + (self.nstates,)), T),
+                M.reshape(shape + T.shape),
+                chi.reshape(shape + T.shape))
+
+    def directionSymmetry(self):
+        """SA.directionSymmetry()
+        Returns (m, mirror) for the symmetry of the spectrum as a function
+        of the field direction: it is invariant under rotations by 2pi/m
+        about z (m = 0 for any angle), under phi -> -phi if *mirror*, and
+        always under B -> -B (time reversal). m is the greatest common
+        divisor of the q of the active Stevens operators, which follows
+        from CF.symmetry, and the mirror is there as long as the crystal
+        field is real (CF.real, no operators with q < 0 switched on)."""
+        self.CF.makeReady()
+        m = 0
+        for ((n, q), c) in zip(self.CF.orders, self.CF.coeff):
+            if c != 0:
+                m = gcd(m, abs(int(q)))
+        return m, self.CF.real
+
+    def _wedge(self, theta, phi):
+        """Maps the directions (theta, phi) to equivalent ones in the
+           irreducible wedge theta <= pi/2, 0 <= phi < 2pi/m (or <= pi/m
+           with the mirror, phi = 0 for m = 0) of directionSymmetry().
+           Returns them and the sign of <Jz> (-1 for the directions
+           mapped by time reversal)."""
+        m, mirror = self.directionSymmetry()
+        theta, phi = np.broadcast_arrays(np.asarray(theta, dtype=float),
+                                         np.asarray(phi, dtype=float))
+        lower = np.cos(theta) < 0
+        sign = np.where(lower, -1, 1)
+        theta = np.where(lower, np.pi - theta, theta)
+        phi = np.where(lower, phi + np.pi, phi)
+        if m == 0:
+            return theta, np.zeros_like(phi), sign
+        period = 2*np.pi/m
+        phi = np.mod(phi, period)
+        phi = np.where(period - phi < 1e-12, 0, phi)
+        if mirror:
+            phi = np.where(phi > period/2, period - phi, phi)
+        return theta, np.where(np.sin(theta) < 1e-12, 0, phi), sign
+
+    def _uniqueDirections(self, B, theta, phi):
+        """Reduces the broadcast fields (magnitude *B*, direction theta,
+           phi) to the distinct ones in the irreducible wedge. Returns the
+           common shape S, the fields (Bx, By, Bz) to compute, the index
+           of the computed field of every point and the signs of <Jz>."""
+        B, theta, phi = np.broadcast_arrays(np.asarray(B, dtype=float),
+                                            np.asarray(theta, dtype=float),
+                                            np.asarray(phi, dtype=float))
+        shape = B.shape
+        theta, phi, sign = self._wedge(theta, phi)
+        points = np.round(np.stack([B.ravel(), theta.ravel(), phi.ravel()],
+                                   axis=-1), 12)
+        points, index = np.unique(points, axis=0, return_inverse=True)
+        B, theta, phi = points.T
+        fields = (B*np.sin(theta)*np.cos(phi), B*np.sin(theta)*np.sin(phi),
+                  B*np.cos(theta))
+        return shape, fields, index.ravel(), sign.ravel()
+
+    def fieldMap(self, B, theta, phi, N=None, chunksize=1024):
+        """SA.fieldMap(B, theta, phi, N=None)
+        Calculates the energies, <Jz> and J transition probabilities
+        (see sweep()) for fields of magnitude *B* (in the units of SA.ZT)
+        along the directions (theta, phi) (in radians from z and x), all
+        broadcast to a common shape S, e.g. theta[:, None] and phi[None, :]
+        for a map on a grid.
+
+        Directions that are equivalent by symmetry (see
+        directionSymmetry()) are diagonalized only once, i.e. only the
+        irreducible wedge of the sphere is computed (1/12 of it for
+        C3v) and the results are unfolded to all the directions.
+
+        Returns a tuple of NumPy arrays (Es, Js, Ps) with shapes S+(N,),
+        S+(N,) and S+(N, N)."""
+        shape, (Bx, By, Bz), index, sign = self._uniqueDirections(B, theta,
+                                                                  phi)
+        Es, Js, Ps = self.sweep(Bx, By, Bz, N=N, chunksize=chunksize)
+        N = Es.shape[-1]
+        return (Es[index].reshape(shape + (N,)),
+                (sign[:, None]*Js[index]).reshape(shape + (N,)),
+                Ps[index].reshape(shape + (N, N)))
+
+    def thermalFieldMap(self, T, B, theta, phi, chunksize=256):
+        """SA.thermalFieldMap(T, B, theta, phi)
+        Calculates the thermodynamics for fields of magnitude *B* along
+        the directions (theta, phi) (broadcast to a common shape S, see
+        fieldMap()) and every temperature in *T*, computing only the
+        irreducible wedge of directions.
+
+        Returns a tuple (TH, M, chi) as thermalSweep(), with the
+        magnetization and susceptibility along the field, which are
+        the same for all the equivalent directions."""
+        if np.any(np.asarray(B) <= 0):
+            raise ValueError("The field has to be nonzero to define "
+                             "the direction of the moment")
+        shape, (Bx, By, Bz), index, sign = self._uniqueDirections(B, theta,
+                                                                  phi)
+        TH, M, chi = self.thermalSweep(T, Bx, By, Bz, chunksize=chunksize)
+        T = TH.T
+        Es = TH.Es[index].reshape(shape + (self.nstates,))
+        return (Thermodynamics(Es, T),
+                M[index].reshape(shape + T.shape),
+                chi[index].reshape(shape + T.shape))
+
+    def powderDirections(self, n=16):
+        """SA.powderDirections(n=16)
+        Returns a quadrature (theta, phi, weights) for averages over all
+        the field directions that covers only the irreducible wedge (see
+        directionSymmetry()): *n* Gauss-Legendre nodes in cos(theta) on
+        [0, 1] times equidistant values of phi (midpoints) on the width
+        of the wedge. The weights sum to 1.
+
+        For the functions of the direction with the symmetry of the
+        spectrum, the rule is exact up to the degree 4n-1 in spherical
+        harmonics, as a product rule with 2n nodes in cos(theta) and
+        4n in phi on the whole sphere, on 1/12 of the points for C3v."""
+        m, mirror = self.directionSymmetry()
+        x, wx = np.polynomial.legendre.leggauss(n)
+        x, wx = (x + 1)/2, wx/2
+        if m == 0:
+            nphi, width = 1, 0
+        elif mirror:
+            nphi, width = -(-2*n//m), np.pi/m
+        else:
+            nphi, width = -(-4*n//m), 2*np.pi/m
+        phi = (np.arange(nphi) + 0.5)*width/nphi
+        theta = np.arccos(x)
+        return (np.repeat(theta, nphi), np.tile(phi, n),
+                np.repeat(wx, nphi)/nphi)
+
+    def powderAverage(self, T, B, n=16, chunksize=256):
+        """SA.powderAverage(T, B, n=16)
+        Powder averages of the magnetization and the susceptibility along
+        the field of magnitude *B* (a number or an array of shape S) at
+        the temperatures *T*, with the quadrature of powderDirections(n).
+
+        Returns a tuple (M, chi) of arrays of shape S+T.shape."""
+        if np.any(np.asarray(B) <= 0):
+            raise ValueError("The field has to be nonzero to define "
+                             "the direction of the moment")
+        theta, phi, weights = self.powderDirections(n)
+        B = np.asarray(B, dtype=float)[..., None]
+        TH, M, chi = self.thermalSweep(T, B*np.sin(theta)*np.cos(phi),
+                                       B*np.sin(theta)*np.sin(phi),
+                                       B*np.cos(theta), chunksize=chunksize)
+        axis = B.ndim - 1
+        return (np.tensordot(M, weights, axes=([axis], [0])),
+                np.tensordot(chi, weights, axes=([axis], [0])))
 
 if __name__ == "__main__":
 
@@ -31,8 +389,6 @@ if __name__ == "__main__":
     import sys
     import re
 
-    from ..core.AngularMomentum import Jrange
-
     j = 8
     if len(sys.argv) > 1:
         m = re.match('([0-9]+)(/2)?', sys.argv[1])
@@ -58,4 +414,4 @@ if __name__ == "__main__":
     print()
     print_np_matrix(sa.Xs)
 
-    print(sa.Xs.H[1, :]*np.diag(Jrange(sa.J))*sa.Xs[:, 0])
+    print(sa.backend.transform(sa.Jz, sa.Xs)[1, 0])
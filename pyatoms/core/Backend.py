@@ -0,0 +1,601 @@
+import numpy as np
+from mpmath import mp
+from .Setup import instrumented
+from .MPArray import MPArray
+
+
+class NumpyBackend:
+    """Linear algebra in double precision on NumPy arrays.
+
+    Diagonalization is done by LAPACK through `numpy.linalg.eigh`.
+    Real matrices are stored as float64, all others as complex128.
+
+    The operations also work on stacks of matrices of shape (..., n, n),
+    which are processed in a single call."""
+
+    name = 'numpy'
+
+    def matrix(self, m):
+        """Converts a matrix (mpmath, NumPy or nested lists)
+           to the backend representation."""
+        if isinstance(m, mp.matrix):
+            m = m.tolist()
+        m = np.array(m, dtype=complex)
+        if not np.any(m.imag):
+            return m.real.copy()
+        return m
+
+    def zeros(self, n):
+        return np.zeros((n, n))
+
+    def size(self, M):
+        return M.shape[-1]
+
+    def diag(self, values):
+        return np.diag(np.array(values, dtype=float))
+
+    def scalar(self, x):
+        """Converts a number to a type that can multiply
+           backend matrices without changing their type."""
+        if isinstance(x, (complex, mp.mpc, np.complexfloating)):
+            return complex(x)
+        return float(x)
+
+    def real(self, M):
+        """Returns the real part of M, as a float64 array."""
+        if np.iscomplexobj(M):
+            return M.real.copy()
+        return M
+
+    def addScaled(self, M, a, X):
+        """Returns M + a*X, modifying M in place when the types allow."""
+        if not np.iscomplexobj(M) and (np.iscomplexobj(X)
+                                       or isinstance(a, complex)):
+            return M + a*X
+        M += a*X
+        return M
+
+    @instrumented
+    def eigh(self, H):
+        """Returns eigenvalues (ascending) and eigenvectors (columns)
+           of the hermitian matrix H."""
+        return np.linalg.eigh(H)
+
+    @instrumented
+    def eigvalsh(self, H):
+        """Returns the eigenvalues (ascending) of the hermitian
+           matrix H, without the eigenvectors."""
+        return np.linalg.eigvalsh(H)
+
+    @instrumented
+    def eighUpdate(self, H, X0, maxiter=10):
+        """Diagonalizes H starting from the approximate eigenvectors X0.
+           LAPACK is faster than any refinement, so this simply calls
+           eigh()."""
+        return self.eigh(H)
+
+    @instrumented
+    def eighLowest(self, H, N):
+        """Returns the lowest N eigenvalues and eigenvectors of H.
+           NumPy has no partial eigensolver, and LAPACK is fast enough
+           for the matrix sizes at hand, so this truncates eigh()."""
+        Es, Xs = np.linalg.eigh(H)
+        return Es[..., :N], Xs[..., :N]
+
+    @instrumented
+    def eighBlocks(self, H, blocks, vectors=True):
+        """Diagonalizes the hermitian matrix H that does not couple the
+           basis states of different *blocks* (lists of indices covering
+           all the basis states), one block at a time.
+
+           Returns eigenvalues (ascending), eigenvectors (columns, None
+           without *vectors*) and the index of the block every
+           eigenvector belongs to."""
+        Es = np.empty(H.shape[0])
+        Xs = np.zeros_like(H) if vectors else None
+        which = np.empty(H.shape[0], dtype=int)
+
+        start = 0
+        for b, idx in enumerate(blocks):
+            cols = np.arange(start, start + len(idx))
+            if vectors:
+                Es[cols], Xs[np.ix_(idx, cols)] = np.linalg.eigh(
+                    H[np.ix_(idx, idx)])
+            else:
+                Es[cols] = np.linalg.eigvalsh(H[np.ix_(idx, idx)])
+            which[cols] = b
+            start += len(idx)
+
+        order = np.argsort(Es, kind='stable')
+        return Es[order], (Xs[:, order] if vectors else None), which[order]
+
+    def adjoint(self, M):
+        return np.swapaxes(M.conj(), -1, -2)
+
+    def transpose(self, M):
+        return np.swapaxes(M, -1, -2)
+
+    def transform(self, op, X):
+        """Returns the matrix X^H*op*X."""
+        return self.adjoint(X) @ op @ X
+
+    def expect(self, op, X):
+        """Returns the vector of expectation values X[:, i]^H*op*X[:, i],
+           i.e. the diagonal of X^H*op*X, without the full product."""
+        return np.sum(X.conj()*(op @ X), axis=-2)
+
+    def columns(self, X, N):
+        """Returns the first N columns of X."""
+        return X[..., :N]
+
+    def diagonal(self, M):
+        return np.diagonal(M, axis1=-2, axis2=-1).copy()
+
+    def abs2(self, M):
+        """Elementwise squared absolute value."""
+        return M.real**2 + M.imag**2
+
+    def tonumpy(self, M):
+        return np.asarray(M)
+
+    def toArrays(self, M):
+        """Returns M as a dictionary of NumPy arrays, e.g. for storing
+           in an ArrayCache (see fromArrays())."""
+        return {'': np.asarray(M)}
+
+    def fromArrays(self, arrays):
+        return arrays['']
+
+
+class MPMathBackend:
+    """Linear algebra in arbitrary precision on mpmath matrices.
+
+    All the calculations are done with the current working precision
+    of mpmath (see `mp.dps` and `mp.workdps`)."""
+
+    name = 'mpmath'
+
+    def matrix(self, m):
+        """Converts a matrix (mpmath, NumPy or nested lists)
+           to the backend representation."""
+        if isinstance(m, mp.matrix):
+            return m
+        return mp.matrix(np.asarray(m).tolist())
+
+    def zeros(self, n):
+        return mp.zeros(n)
+
+    def size(self, M):
+        return M.cols
+
+    def diag(self, values):
+        return mp.diag(values)
+
+    def scalar(self, x):
+        """Converts a number to a type that can multiply
+           backend matrices without changing their type."""
+        return mp.mpmathify(x)
+
+    def real(self, M):
+        """Returns the real part of M, with mpf elements only, so that
+           mp.eigh() dispatches to the real symmetric solver (mp.eigsy)
+           and all the products with it stay real."""
+        if any(type(x) is mp.mpc for x in M):
+            return M.apply(mp.re)
+        return M
+
+    def addScaled(self, M, a, X):
+        """Returns M + a*X."""
+        return M + a*X
+
+    @instrumented
+    def eigh(self, H):
+        """Returns eigenvalues (ascending) and eigenvectors (columns)
+           of the hermitian matrix H."""
+        return mp.eigh(H)
+
+    @instrumented
+    def eigvalsh(self, H):
+        """Returns the eigenvalues (ascending) of the hermitian
+           matrix H. Without the eigenvectors, the Householder
+           reflections are not accumulated, which saves more than half
+           of the work."""
+        return mp.eigh(H, eigvals_only=True)
+
+    @instrumented
+    def eighUpdate(self, H, X0, maxiter=10):
+        """Diagonalizes H starting from the approximate eigenvectors X0
+           (e.g. those of a slightly different H).
+
+           The eigenvectors are refined with the iterative scheme of
+           Ogita & Aishima (Japan J. Indust. Appl. Math. 35, 1007 (2018)),
+           which doubles the number of correct digits with every iteration
+           and needs only four matrix products per iteration. The first
+           iterations, up to double precision accuracy, are done with
+           NumPy (see `_refine()`), and if X0 is too far from the solution
+           for that, the double precision eigenvectors are used instead.
+
+           Returns eigenvalues (ascending) and eigenvectors (columns),
+           or None if the refinement does not converge within *maxiter*
+           iterations."""
+        n = H.rows
+        normH = mp.mnorm(H, 'f')
+        if normH == 0:
+            return None
+
+        npb = backends['numpy']
+        Hd = npb.matrix(H)
+        Xd = _refine(Hd, npb.matrix(X0), maxiter, 64*np.finfo(float).eps)
+        if Xd is None:
+            Xd = np.linalg.eigh(Hd)[1]
+        X = self.matrix(Xd)
+
+        def squares(M):
+            return mp.fsum(abs(x)**2 for row in M for x in row)
+
+        def rotate(M, a, b, V, k):
+            """M[:, a:b] *= V and M[a:b, :] = V^H M[a:b, :] for lists."""
+            for row in M:
+                row[a:b] = [mp.fsum(row[a+i]*V[i, j] for i in range(k))
+                            for j in range(k)]
+            rows = M[a:b]
+            for j in range(k):
+                M[a+j] = [mp.fsum(mp.conj(V[i, j])*rows[i][c]
+                                  for i in range(k))
+                          for c in range(len(M[a]))]
+
+        for iteration in range(maxiter + 1):
+            S = (X.H*(H*X)).tolist()
+            # the hermitian part: the rounding errors of S_ij - S_ji^*
+            # would enter the orthogonality of close pairs magnified
+            S = [[(S[i][j] + mp.conj(S[j][i]))/2 for j in range(n)]
+                 for i in range(n)]
+            R = (X.H*X).tolist()
+            R = [[(i == j) - R[i][j] for j in range(n)] for i in range(n)]
+            lam = [mp.re(S[i][i])/(1 - mp.re(R[i][i])) for i in range(n)]
+
+            order = sorted(range(n), key=lam.__getitem__)
+            if order != list(range(n)):
+                X = mp.matrix([[X[r, i] for i in order] for r in range(n)])
+                S = [[S[i][j] for j in order] for i in order]
+                R = [[R[i][j] for j in order] for i in order]
+                lam = [lam[i] for i in order]
+
+            # the residual of the current X, summed directly (subtracting
+            # the diagonal from squares(S) would lose half the digits)
+            offS = mp.sqrt(mp.fsum(abs(S[i][j] - (lam[i] if i == j else 0))**2
+                                   for i in range(n) for j in range(n)))
+            normR = mp.sqrt(squares(R))
+            rho = max(offS/normH, normR)
+            if rho <= n*mp.eps:
+                return mp.matrix(lam), X
+            if rho > 0.01 or iteration == maxiter:
+                return None
+            # pairs closer than sqrt(eps) stay clusters: the rounding
+            # errors of their first-order corrections would not square
+            delta = max(2*(offS + normH*normR), mp.sqrt(mp.eps)*normH)
+
+            clusters = _clusters(lam, delta, [[abs(S[i][j]) +
+                                               abs(lam[j]*R[i][j])
+                                               for j in range(n)]
+                                              for i in range(n)])
+            for (a, b) in clusters:
+                k = b - a
+                if k > 1:
+                    V = mp.eigh(mp.matrix([[S[i][j] for j in range(a, b)]
+                                           for i in range(a, b)]))[1]
+                    X[:, a:b] = X[:, a:b]*V
+                    rotate(S, a, b, V, k)
+                    rotate(R, a, b, V, k)
+                    for i in range(a, b):
+                        lam[i] = mp.re(S[i][i])/(1 - mp.re(R[i][i]))
+
+            cluster = [c for (c, (a, b)) in enumerate(clusters)
+                       for i in range(a, b)]
+            E = [[R[i][j]/2 if cluster[i] == cluster[j]
+                  else (S[i][j] + lam[j]*R[i][j])/(lam[j] - lam[i])
+                  for j in range(n)] for i in range(n)]
+            X = X + X*mp.matrix(E)
+
+    @instrumented
+    def eighLowest(self, H, N, maxiter=50):
+        """Returns the lowest N eigenvalues (ascending) and eigenvectors
+           (columns) of the hermitian matrix H without diagonalizing it
+           as a whole.
+
+           The eigenvectors are found by shift-and-invert subspace
+           iteration seeded with the double precision solution: the
+           wanted eigenvalues are grouped into clusters narrower than
+           the double precision accuracy allows to resolve, for every
+           cluster H - sigma is factorized once with sigma in its middle,
+           and the subspace is improved by solving (H - sigma)*Y = Q
+           for the columns of the cluster, followed by a Rayleigh-Ritz
+           step, until the residual is at the level of the working
+           precision. Every iteration gains the digits of the ratio
+           of the half-width of a cluster (at least the double precision
+           error) to its distance from the other eigenvalues, so e.g.
+           a ground doublet well separated from the excited states takes
+           about one iteration per 13 digits.
+
+           Falls back to a full diagonalization if the wanted eigenvalues
+           are not well separated from the rest, or if there are so many
+           of them that the full diagonalization is cheaper."""
+        n = H.rows
+        Ed, Xd = np.linalg.eigh(backends['numpy'].matrix(H))
+        normH = mp.mnorm(H, 'f')
+        if 2*N <= n and normH != 0:
+            error = 16*np.finfo(float).eps*float(normH)
+            resolved = np.sqrt(error*float(normH))
+            clusters = []
+            for i in range(N):
+                if i and Ed[i] - Ed[i-1] <= resolved:
+                    clusters[-1].append(i)
+                else:
+                    clusters.append([i])
+            ratio = max((Ed[c[-1]] - Ed[c[0]])/2 + error for c in clusters)
+            ratio /= min(min(Ed[c[0]] - Ed[c[0]-1] if c[0] else np.inf,
+                             Ed[c[-1]+1] - Ed[c[-1]]) for c in clusters)
+            # rough cost in units of LU factorizations (a full
+            # diagonalization takes about eight of them)
+            iterations = mp.prec*np.log(2)/-np.log(min(ratio, 0.5))
+            if ratio < 0.01 and len(clusters) + 2*N*iterations/n < 8:
+                try:
+                    return self._shiftInvert(H, clusters, Ed,
+                                             self.matrix(Xd[:, :N]),
+                                             n*mp.eps*normH, maxiter)
+                except ArithmeticError:  # also ZeroDivisionError
+                    pass
+        E, X = mp.eigh(H)
+        return E[:N], X[:, :N]
+
+    def _shiftInvert(self, H, clusters, Ed, Q, tol, maxiter):
+        LU = []
+        for c in clusters:
+            sigma = mp.mpf(float(Ed[c[0]] + Ed[c[-1]])/2)
+            LU.append(mp.LU_decomp(H - sigma*mp.eye(H.rows)))
+        for iteration in range(maxiter):
+            Q = mp.qr(Q, mode='skinny')[0]
+            HQ = H*Q
+            E, V = mp.eigh(Q.H*HQ)
+            Q, HQ = Q*V, HQ*V
+            if mp.mnorm(HQ - Q*mp.diag(E), 'f') <= tol:
+                return E, Q
+            Y = []
+            for (c, (A, p)) in zip(clusters, LU):
+                Y.extend(list(mp.U_solve(A, mp.L_solve(A, Q.column(i), p)))
+                         for i in c)
+            Q = mp.matrix(Y).T
+        raise ArithmeticError('Shift-and-invert iteration did not converge')
+
+    @instrumented
+    def eighBlocks(self, H, blocks, vectors=True):
+        """Diagonalizes the hermitian matrix H that does not couple the
+           basis states of different *blocks* (lists of indices covering
+           all the basis states), one block at a time.
+
+           Returns eigenvalues (ascending), eigenvectors (columns, None
+           without *vectors*) and the index of the block every
+           eigenvector belongs to."""
+        states = []
+        for b, idx in enumerate(blocks):
+            block = mp.matrix([[H[i, j] for j in idx] for i in idx])
+            if not vectors:
+                states.extend((E, b, None)
+                              for E in mp.eigh(block, eigvals_only=True))
+                continue
+            E, X = mp.eigh(block)
+            for k in range(len(idx)):
+                states.append((E[k], b, [X[i, k] for i in range(len(idx))]))
+        states.sort(key=lambda state: state[0])
+
+        Es = mp.matrix([E for (E, b, x) in states])
+        if not vectors:
+            return Es, None, np.array([b for (E, b, x) in states])
+        Xs = mp.zeros(H.rows)
+        for k, (E, b, x) in enumerate(states):
+            for i, v in zip(blocks[b], x):
+                Xs[i, k] = v
+        return Es, Xs, np.array([b for (E, b, x) in states])
+
+    def adjoint(self, M):
+        return M.H
+
+    def transpose(self, M):
+        return M.T
+
+    def transform(self, op, X):
+        """Returns the matrix X^H*op*X."""
+        return X.H*op*X
+
+    def expect(self, op, X):
+        """Returns the vector of expectation values X[:, i]^H*op*X[:, i],
+           i.e. the diagonal of X^H*op*X, without the full product."""
+        ans = mp.zeros(X.cols, 1)
+        for i in range(X.cols):
+            x = X.column(i)
+            ans[i] = mp.fdot(op*x, x, conjugate=True)
+        return ans
+
+    def columns(self, X, N):
+        """Returns the first N columns of X."""
+        return X[:, :N]
+
+    def diagonal(self, M):
+        imax = min(M.rows, M.cols)
+        ans = mp.zeros(imax, 1)
+        for i in range(imax):
+            ans[i] = M[i, i]
+        return ans
+
+    def abs2(self, M):
+        """Elementwise squared absolute value."""
+        return M.apply(lambda x: mp.re(x)**2 + mp.im(x)**2)
+
+    def tonumpy(self, M):
+        """Returns M as a NumPy array, float64 if it is real."""
+        return backends['numpy'].matrix(M)
+
+    def toArrays(self, M):
+        """Returns M as a dictionary of NumPy arrays, e.g. for storing
+           in an ArrayCache (see fromArrays()), with the exact values
+           (see MPArray)."""
+        return MPArray(M).arrays()
+
+    def fromArrays(self, arrays):
+        return MPArray.fromArrays(arrays).tomatrix()
+
+
+def _clusters(lam, delta, coupling):
+    """Splits the sorted approximate eigenvalues *lam* into clusters
+       (index ranges (a, b)) of eigenvalues that are closer than *delta*
+       or so strongly coupled (coupling[i][j] = |S_ij| + |lam_j R_ij|)
+       that a first-order correction between them would not be small."""
+    n = len(lam)
+    reach = list(range(n))
+    for i in range(n):
+        for j in range(i+1, n):
+            gap = lam[j] - lam[i]
+            if gap <= delta or coupling[i][j] > gap/32:
+                reach[i] = j
+    clusters = []
+    a = b = 0
+    for i in range(n):
+        b = max(b, reach[i])
+        if b == i:
+            clusters.append((a, b+1))
+            a = b = i+1
+    return clusters
+
+
+def _refine(H, X, maxiter, tol):
+    """Refines the approximate eigenvectors X of the NumPy matrix H
+       in double precision (see MPMathBackend.eighUpdate()) until the
+       residual is below *tol*. Returns the eigenvectors sorted by energy
+       or None if the refinement fails."""
+    n = H.shape[0]
+    normH = np.linalg.norm(H)
+    if normH == 0:
+        return None
+    X = X.astype(np.result_type(H, X))  # complex H from real X0
+
+    for iteration in range(maxiter):
+        S = X.conj().T @ H @ X
+        S = (S + S.conj().T)/2
+        R = np.eye(n) - X.conj().T @ X
+        lam = np.real(np.diagonal(S))/(1 - np.real(np.diagonal(R)))
+
+        order = np.argsort(lam)
+        X, lam = X[:, order], lam[order]
+        S, R = S[np.ix_(order, order)], R[np.ix_(order, order)]
+
+        offS = np.linalg.norm(S - np.diag(lam))
+        normR = np.linalg.norm(R)
+        rho = max(offS/normH, normR)
+        if rho <= tol:
+            return X
+        if rho > 0.01:
+            return None
+        delta = max(2*(offS + normH*normR), np.sqrt(tol)*normH)
+
+        clusters = _clusters(lam, delta, np.abs(S) + np.abs(lam*R))
+        cluster = np.empty(n, dtype=int)
+        for (c, (a, b)) in enumerate(clusters):
+            cluster[a:b] = c
+            if b - a > 1:
+                V = np.linalg.eigh(S[a:b, a:b])[1]
+                X[:, a:b] = X[:, a:b] @ V
+                S[:, a:b] = S[:, a:b] @ V
+                S[a:b, :] = V.conj().T @ S[a:b, :]
+                R[:, a:b] = R[:, a:b] @ V
+                R[a:b, :] = V.conj().T @ R[a:b, :]
+                lam[a:b] = (np.real(np.diagonal(S[a:b, a:b])) /
+                            (1 - np.real(np.diagonal(R[a:b, a:b]))))
+
+        same = cluster[:, None] == cluster[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            E = np.where(same, R/2, (S + lam*R)/(lam - lam[:, None]))
+        X = X + X @ E
+    return None
+
+
+backends = {
+    'numpy': NumpyBackend(),
+    'mpmath': MPMathBackend(),
+    }
+
+
+def getBackend(backend=None):
+    """Returns the backend object for *backend*, which can be a backend
+       name ('numpy' or 'mpmath'), a backend object or None.
+
+       By default, the NumPy backend is used, unless the mpmath working
+       precision was raised above double precision (e.g. within
+       `mp.workdps`), in which case the mpmath backend is used."""
+    if backend is None:
+        backend = 'mpmath' if mp.prec > 53 else 'numpy'
+    if isinstance(backend, str):
+        try:
+            return backends[backend]
+        except KeyError:
+            raise ValueError('Unsupported backend "{}"'.format(backend))
+    return backend
+
+
+if __name__ == '__main__':
+    import unittest
+    import warnings
+    from pyatoms.J.SingleAtom import SingleAtom
+
+    def kramers(backend='mpmath'):
+        """J = 15/2 in C6v with Kramers doublets that a small By splits
+           by less than 1e-11 meV"""
+        sa = SingleAtom(7.5, 'f', backend=backend)
+        sa.setDiskCache(None)
+        sa.setMemoryCache(0)
+        sa.CF.setSymmetry('C6v')
+        sa.CF.setCoefficients([0.06578400975568388, 0, -4.207186158452095e-06,
+                               0])
+        return sa
+
+    class testEighUpdate(unittest.TestCase):
+        def assertSolved(self, H, Es, Xs, tol):
+            n = H.rows
+            S = Xs.H*H*Xs
+            self.assertLess(max(abs(S[i, j]) for i in range(n)
+                                for j in range(n) if i != j), tol)
+            self.assertLess(mp.mnorm(Xs.H*Xs - mp.eye(n), 'f'), tol)
+            for i in range(n):
+                self.assertLess(abs(Es[i] - mp.re(S[i, i])), tol)
+
+        def test_closePairs(self):
+            """ the warm start must not return unconverged eigenpairs"""
+            for dps in (15, 30):
+                with mp.workdps(dps):
+                    sa = kramers()
+                    sa.setWarmStart()
+                    sa.makeReady()
+                    sa.ZT.setBy(-0.003251950491711282)
+                    sa.makeReady()
+                    self.assertSolved(sa.H, sa._Es, sa._Xs, 100*mp.eps)
+                    cold = kramers()
+                    cold.ZT.setBy(-0.003251950491711282)
+                    self.assertTrue(np.allclose(sa.Es, cold.Es, atol=1e-12))
+
+        def test_realToComplex(self):
+            """ real starting vectors of a complex Hamiltonian"""
+            sa = kramers('numpy')
+            sa.ZT.setBx(0.1)
+            X0 = sa.Xs
+            sa.ZT.setBxyz(0.1, 1e-4, 0)
+            H = sa.H
+            self.assertTrue(np.iscomplexobj(H))
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                X = _refine(H, X0, 10, 64*np.finfo(float).eps)
+            self.assertIsNotNone(X)
+            S = X.conj().T @ H @ X
+            self.assertTrue(np.allclose(S, np.diag(np.diag(S)), atol=1e-12))
+            self.assertTrue(np.allclose(X.conj().T @ X, np.eye(len(X)),
+                                        atol=1e-12))
+
+    unittest.main()
@@ -0,0 +1,224 @@
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from mpmath import mp
+
+
+def canonical(value):
+    """Converts *value* (nested tuples, lists and dictionaries of numbers,
+       strings, NumPy arrays and mpmath numbers) to nested tuples of plain
+       Python objects, whose repr() is stable across sessions and library
+       versions, e.g. for the keys of an ArrayCache."""
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted(((canonical(k), canonical(v))
+                             for (k, v) in value.items()), key=repr))
+    if isinstance(value, np.ndarray):
+        return ('array', value.shape, canonical(value.tolist()))
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, mp.mpf):
+        sign, man, exp, bc = value._mpf_
+        return ('mpf', sign, int(man), exp, bc)
+    if isinstance(value, mp.mpc):
+        return ('mpc', canonical(value.real), canonical(value.imag))
+    return value
+
+
+class LRUCache:
+    """An in-memory mapping that keeps at most *maxsize* entries,
+    discarding the least recently used ones first."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class DiskCache:
+    """A persistent mapping stored as one pickle file per entry in
+    *directory*. Keys can be any object with a stable `repr()`.
+
+    Failures to read or write the cache files are ignored, the cache
+    then simply behaves as if the entry was missing."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        if stored_key != key:  # hash collision
+            return default
+        return value
+
+    def put(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class TieredCache:
+    """A two-tier cache: an in-memory LRU tier in front of an optional
+    on-disk tier. Entries found on disk are promoted to memory.
+
+    The disk tier is disabled as long as *directory* is None,
+    see `setDirectory()`."""
+
+    def __init__(self, maxsize=128, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.disk = None
+        self.setDirectory(directory)
+
+    def setDirectory(self, directory):
+        """Sets the directory of the on-disk tier (None disables it)."""
+        self.disk = DiskCache(directory) if directory else None
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, default)
+        if value is default and self.disk is not None:
+            value = self.disk.get(key, default)
+            if value is not default:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def clear(self, disk=False):
+        """Empties the memory tier, and also the disk tier if *disk*."""
+        self.memory.clear()
+        if disk and self.disk is not None:
+            self.disk.clear()
+
+
+class ArrayCache:
+    """A persistent, size-bounded mapping from keys to dictionaries of
+    NumPy arrays, stored in *directory* as one subdirectory of .npy files
+    per entry, named by the SHA-256 hash of the key (see `canonical()`).
+
+    Arrays larger than *mmapbytes* are loaded memory-mapped (read-only).
+    When the entries take more than *maxbytes*, the least recently used
+    ones are deleted. As with DiskCache, failures to read or write the
+    files make the entry count as missing."""
+
+    def __init__(self, directory, maxbytes=2**30, mmapbytes=2**20):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.mmapbytes = mmapbytes
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, 'key'), 'r') as f:
+                if f.read() != repr(key):  # hash collision
+                    return default
+            arrays = {}
+            for name in os.listdir(path):
+                if name.endswith('.npy'):
+                    file = os.path.join(path, name)
+                    large = os.path.getsize(file) > self.mmapbytes
+                    arrays[name[:-4]] = np.load(
+                        file, mmap_mode='r' if large else None)
+            os.utime(path)  # the modification time marks the last use
+        except (OSError, ValueError):
+            return default
+        return arrays
+
+    def put(self, key, arrays):
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.directory, suffix='.tmp')
+            with open(os.path.join(tmp, 'key'), 'w') as f:
+                f.write(repr(key))
+            for (name, array) in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+            try:
+                os.replace(tmp, path)
+            except OSError:  # already stored by someone else
+                shutil.rmtree(tmp, ignore_errors=True)
+            self._evict()
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Returns a list of (last use, size, path) of all the entries."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.endswith('.tmp'):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total <= self.maxbytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        try:
+            entries = self._entries()
+        except OSError:
+            return
+        for (mtime, size, path) in entries:
+            shutil.rmtree(path, ignore_errors=True)
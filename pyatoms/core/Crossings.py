@@ -0,0 +1,122 @@
+from collections import namedtuple
+
+import numpy as np
+
+Crossing = namedtuple('Crossing', ['x', 'gap', 'mixing', 'swap'])
+Crossing.__doc__ = """An avoided crossing (a local minimum of the gap) at the
+parameter value x, with the gap E_b - E_a there. mixing is the weight
+|<a(x_l)|a(x)>|^2 of the state a coming from the left of the crossing
+in the state a at the crossing (1/2 for an ideal two-level anticrossing),
+swap is the overlap |<a(x_l)|b(x_r)>|^2 of the states on the two
+sides (close to 1 when the levels exchange their character)."""
+
+
+class _Evaluator:
+    """Energies, Hellmann-Feynman slopes and eigenvectors of two levels
+       of a system as a function of a parameter set by *setter*."""
+
+    def __init__(self, system, setter, levels, h):
+        self.system = system
+        self.setter = setter
+        self.a, self.b = levels
+        self.h = h
+
+    def gap(self, x):
+        """Returns the gap E_b - E_a at x and its derivative."""
+        S = self.system
+        h = self.h*max(abs(x), 1)
+        self.setter(x + h)
+        Hp = S.H.copy()
+        self.setter(x - h)
+        Hm = S.H.copy()
+        self.setter(x)
+        H = S.H
+        # <i|dH/dx|i> with dH/dx by central differences of H only
+        EH, DH = S.transitions(H, (Hp - Hm)/(2*h), N=self.b+1)
+        E = np.real(np.diagonal(S.backend.tonumpy(EH)))
+        D = np.real(np.diagonal(S.backend.tonumpy(DH)))
+        return E[self.b] - E[self.a], D[self.b] - D[self.a]
+
+    def states(self, x):
+        self.setter(x)
+        S = self.system
+        X = S.backend.tonumpy(S.backend.columns(S.Xs, self.b+1))
+        return X[:, self.a], X[:, self.b]
+
+
+def _overlap(x, y):
+    return float(abs(np.vdot(x, y))**2)
+
+
+def _refine(f, lo, hi, flo, fhi, xtol, maxiter):
+    """Locates the minimum of a function in [lo, hi], given the values
+       and derivatives f(x) = (g, g') at both ends with g'(lo) < 0 <
+       g'(hi). Steps to the intersection of the tangents at the ends,
+       which is exact for a V-shaped gap far from its minimum, falling
+       back to bisection when the bracket does not shrink fast enough."""
+    best = min((flo[0], lo), (fhi[0], hi))
+    widths = [np.inf, np.inf]
+    for iteration in range(maxiter):
+        if hi - lo <= xtol:
+            break
+        (glo, dlo), (ghi, dhi) = flo, fhi
+        x = (ghi - glo + dlo*lo - dhi*hi)/(dlo - dhi)
+        margin = 1e-3*(hi - lo)
+        if not lo + margin < x < hi - margin or hi - lo > widths[-2]/2:
+            x = (lo + hi)/2
+        widths.append(hi - lo)
+        fx = f(x)
+        best = min(best, (fx[0], x))
+        if fx[1] < 0:
+            lo, flo = x, fx
+        elif fx[1] > 0:
+            hi, fhi = x, fx
+        else:
+            break
+    return best[1], best[0]
+
+
+def findCrossings(system, setter, start, stop, levels=(0, 1), npoints=32,
+                  grid=None, xtol=None, maxiter=60, h=1e-7):
+    """findCrossings(system, setter, start, stop, levels=(0, 1), npoints=32)
+    Finds the avoided crossings of two levels (eigenstates ordered by
+    energy) of a QuantumSystem as a function of a parameter x in
+    [start, stop], i.e. the local minima of the gap E_b - E_a. The
+    parameter is set by the function *setter*, e.g. atom.ZT.setBz,
+    atom.ZT.setBtheta or lambda c: atom.CF.setCoefficient(4, 3, c).
+
+    The gap and its derivative (from the Hellmann-Feynman theorem, with
+    dH/dx from H at x +- h*max(|x|, 1)) are evaluated on a coarse grid
+    (*npoints* equidistant points or the given *grid*). Every sign change
+    of the derivative brackets a minimum, which is then refined down to
+    *xtol* (by default 1e-12*(stop - start)) in a few steps, however
+    narrow the anticrossing. The grid only has to resolve the distances
+    between neighbouring crossings.
+
+    Returns a list of Crossing(x, gap, mixing, swap), ordered by x.
+    The parameter is left at *stop*."""
+    if grid is None:
+        grid = np.linspace(start, stop, npoints)
+    grid = np.sort(np.asarray(grid, dtype=float))
+    a, b = levels
+    if not 0 <= a < b < system.nstates:
+        raise ValueError("Invalid pair of levels {}".format(levels))
+    if xtol is None:
+        xtol = 1e-12*(grid[-1] - grid[0])
+
+    E = _Evaluator(system, setter, (a, b), h)
+    values = [E.gap(x) for x in grid]
+
+    crossings = []
+    for i in range(len(grid) - 1):
+        if values[i][1] < 0 <= values[i+1][1]:
+            x, gap = _refine(E.gap, grid[i], grid[i+1], values[i],
+                             values[i+1], xtol, maxiter)
+            left = E.states(grid[i])
+            right = E.states(grid[i+1])
+            center = E.states(x)
+            crossings.append(Crossing(float(x), float(gap),
+                                      _overlap(left[0], center[0]),
+                                      _overlap(left[0], right[1])))
+    setter(grid[-1])
+    return crossings
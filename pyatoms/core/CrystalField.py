@@ -1,16 +1,18 @@
 from . import StevensOperators as StOp
-from mpmath import mp
 from .Setup import SetupClass, setupmethod
+from .Backend import getBackend
+from .LinearCombination import LinearCombination
 
 
 class CrystalField(SetupClass):
 
     def __init__(self, J=0, orb=0, ssym='', coeff=[],
-                 no_constant_term=False, parent=None):
+                 no_constant_term=False, parent=None, backend=None):
 
         SetupClass.__init__(self, parent)
 
         self.no_constant_term = no_constant_term
+        self.backend = getBackend(backend)
 
         self.J = 0
         self._sz = int(2*self.J+1)
@@ -20,6 +22,10 @@ class CrystalField(SetupClass):
         self.coeff = []
         self.orders = []
         self.xorders = []  # additional orders, not user-controlled
+        self.ops = []
+        self._sum = None
+        self._sumops = None
+        self.real = True
 
         self.setJ(J)
         self.setOrbital(orb)
@@ -79,7 +85,7 @@ class CrystalField(SetupClass):
                 if n % 4 == 0:
                     return cn(n)
                 elif n % 2 == 0:
-                    return cn(n/2)
+                    return cn(n//2)
 
             elif stype == 'C':
                 if subtype is None:
@@ -155,7 +161,7 @@ class CrystalField(SetupClass):
         # make matrices
 
         self.ops = [
-            StOp.O(self.J, nn, q, self.no_constant_term)
+            StOp.O(self.J, nn, q, self.no_constant_term, self.backend)
             for (nn, q) in self.orders]
 
     def rotate(self, angle):
@@ -208,18 +214,48 @@ class CrystalField(SetupClass):
             raise ValueError('Stevens operator not corresponding to symmetry')
         self.coeff[self.orders.index((n, q))] = coeff
 
-    def _build(self):
-        # traceback.print_stack()
-        if any(q < 0 for (n, q) in self.orders):
-            self.CF = mp.zeros(self._sz)
-        else:
-            self.CF = mp.zeros(self._sz)
+    def parameters(self):
+        return ('CrystalField', self.J, self.no_constant_term,
+                self.orders, self.coeff)
 
-        for (i, op) in enumerate(self.ops):
-            self.CF += op*self.coeff[i]
+    def _build(self):
+        # The operators with q < 0 are imaginary: the crystal field is
+        # real symmetric (CF.real) unless one of them is switched on
+        self.real = all(complex(c).imag == 0 and (q >= 0 or c == 0)
+                        for ((n, q), c) in zip(self.orders, self.coeff))
+        # The operator sum is only recomputed when the operators change,
+        # coefficient changes are applied to it incrementally
+        if self._sum is None or self._sumops is not self.ops:
+            self._sum = LinearCombination(self.backend, self._sz, self.ops)
+            self._sumops = self.ops
+        self.CF = self._sum.update(self.coeff)
 
 if __name__ == "__main__":
     cf = CrystalField()
     cf.setJ(1)
     cf.setOrbital('p')
     cf.setSymmetry('C3v')
+
+    import unittest
+    import numpy as np
+
+    class testCrystalField(unittest.TestCase):
+        def test_rotoreflections(self):
+            """ S6 and S2 allow the same operators as C3 and C1"""
+            for (S, C) in (('S6', 'C3'), ('S2', 'C1'), ('S4', 'C4')):
+                fields = []
+                for ssym in (S, C):
+                    cf = CrystalField(backend='numpy')
+                    cf.setJ(4)
+                    cf.setOrbital('f')
+                    cf.setSymmetry(ssym)
+                    cf.setCoefficients([0.1/(k+1)
+                                        for k in range(len(cf.orders))])
+                    cf.makeReady()
+                    self.assertTrue(all(type(q) is int for (n, q)
+                                        in cf.orders))
+                    fields.append((cf.orders, np.array(cf.CF)))
+                self.assertEqual(fields[0][0], fields[1][0])
+                self.assertTrue(np.allclose(fields[0][1], fields[1][1]))
+
+    unittest.main()
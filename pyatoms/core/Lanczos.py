@@ -0,0 +1,80 @@
+import numpy as np
+from .Setup import instrumented
+
+
+def _orthonormalize(W, V, rng):
+    """Orthonormalizes the columns of W against the orthonormal columns
+       of V and among themselves (twice, for stability). Columns that
+       vanish are replaced by random vectors."""
+    for sweep in range(2):
+        if V.shape[1]:
+            W = W - V @ (V.conj().T @ W)
+        Q, R = np.linalg.qr(W)
+        lost = np.abs(np.diagonal(R)) <= 1e-10*max(np.max(np.abs(R)), 1e-300)
+        if np.any(lost):
+            Q[:, lost] = rng.standard_normal((len(Q), np.sum(lost)))
+            if V.shape[1]:
+                Q = Q - V @ (V.conj().T @ Q)
+            Q = np.linalg.qr(Q)[0]
+        W = Q
+    return W
+
+
+@instrumented
+def lanczos(matvec, n, k, dtype=complex, block=2, ncv=None, tol=1e-12,
+            maxiter=1000, seed=0):
+    """lanczos(matvec, n, k, dtype=complex, block=2, ncv=None, tol=1e-12)
+    Finds the lowest k eigenvalues and eigenvectors of a hermitian
+    n x n operator, which only has to be given as a function *matvec*
+    that multiplies an (n, m) array of column vectors.
+
+    This is a thick-restarted block Lanczos method with full
+    reorthogonalization: the Krylov basis is extended by *block* vectors
+    at a time (so degenerate levels up to that multiplicity, e.g. Kramers
+    doublets, are all found), the Ritz pairs are extracted from the
+    projection of the operator on the basis, and when the basis reaches
+    *ncv* vectors it is restarted from the best Ritz vectors.
+
+    Converged when the residuals |H x - E x| of all the k Ritz pairs
+    are below tol*|H|. Returns the eigenvalues (ascending) and the
+    eigenvectors (columns) as NumPy arrays, or raises ValueError if not
+    converged within *maxiter* extensions."""
+    if ncv is None:
+        ncv = max(2*k + 4*block, 20)
+    ncv = min(ncv, n)
+    if k > n or k + block > ncv:
+        raise ValueError("Too many states requested")
+
+    rng = np.random.default_rng(seed)
+    V = np.zeros((n, 0), dtype=dtype)
+    AV = np.zeros((n, 0), dtype=dtype)
+    T = np.zeros((0, 0), dtype=dtype)
+    W = _orthonormalize(rng.standard_normal((n, block)).astype(dtype), V, rng)
+
+    for iteration in range(maxiter):
+        AW = np.asarray(matvec(W))
+        T = np.block([[T, V.conj().T @ AW],
+                      [W.conj().T @ AV, W.conj().T @ AW]])
+        T = (T + T.conj().T)/2
+        V = np.hstack([V, W])
+        AV = np.hstack([AV, AW])
+
+        theta, S = np.linalg.eigh(T)
+        Y = V @ S[:, :k]
+        R = AV @ S[:, :k] - Y*theta[:k]
+        res = np.linalg.norm(R, axis=0)
+        scale = max(np.max(np.abs(theta)), 1e-300)
+        if np.all(res <= tol*scale) or V.shape[1] == n:
+            return theta[:k], Y
+
+        # the next block of the Krylov space, which contains
+        # the residuals of all the Ritz vectors
+        W = _orthonormalize(AW, V, rng)
+        if V.shape[1] + block > ncv:
+            # thick restart from the lowest Ritz vectors
+            p = max(k, (ncv - block)//2)
+            V, AV = V @ S[:, :p], AV @ S[:, :p]
+            T = np.diag(theta[:p]).astype(dtype)
+        W = W[:, :n - V.shape[1]]
+
+    raise ValueError("Lanczos iteration did not converge")
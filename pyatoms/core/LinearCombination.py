@@ -0,0 +1,52 @@
+class LinearCombination:
+    """A matrix sum_k c_k*M_k of fixed basis matrices M_k, that is kept
+    up to date incrementally: when coefficients change, only
+    (c_new - c_old)*M_k is added for the changed terms. The sum is
+    accumulated in place, so LC.update() hands out a copy, which later
+    updates leave alone.
+
+    The sum is recomputed from scratch (skipping terms with zero
+    coefficients) on the first update, after *maxupdates* incremental
+    updates to limit the accumulation of rounding errors, when most
+    of the coefficients change at once, and when a coefficient is set
+    to zero, so that switched-off terms vanish exactly.
+    """
+
+    def __init__(self, backend, size, matrices=(), maxupdates=100):
+        self.backend = backend
+        self.size = size
+        self.matrices = list(matrices)
+        self.maxupdates = maxupdates
+
+        self.coefficients = None
+        self._matrix = None
+        self._updates = 0
+
+    def update(self, coefficients):
+        """Sets the coefficients and returns the updated matrix."""
+        coefficients = [self.backend.scalar(c) for c in coefficients]
+        if len(coefficients) != len(self.matrices):
+            raise ValueError("Wrong number of coefficients")
+
+        if self.coefficients is not None:
+            changed = [k for (k, c) in enumerate(coefficients)
+                       if c != self.coefficients[k]]
+            if (self._updates < self.maxupdates
+                    and 2*len(changed) <= len(self.matrices)
+                    and all(coefficients[k] != 0 for k in changed)):
+                for k in changed:
+                    self._matrix = self.backend.addScaled(
+                        self._matrix,
+                        coefficients[k] - self.coefficients[k],
+                        self.matrices[k])
+                self.coefficients = coefficients
+                self._updates += len(changed) > 0
+                return self._matrix.copy()
+
+        self._matrix = self.backend.zeros(self.size)
+        for (c, M) in zip(coefficients, self.matrices):
+            if c != 0:
+                self._matrix = self.backend.addScaled(self._matrix, c, M)
+        self.coefficients = coefficients
+        self._updates = 0
+        return self._matrix.copy()
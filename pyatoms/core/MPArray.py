@@ -0,0 +1,179 @@
+import numpy as np
+from mpmath import mp
+from mpmath.libmp import finf, fninf, fnan
+
+
+def _parts(values):
+    """Splits mpmath numbers into their real and imaginary parts (mpf)."""
+    re = [mp.re(x) for x in values]
+    im = [mp.im(x) for x in values]
+    return re, (im if any(im) else None)
+
+
+# inf, -inf and nan have a zero mantissa like 0, told apart by the exponent
+_special = {x[2]: x for x in (finf, fninf, fnan)}
+
+
+def _pack(parts):
+    """Signed mantissas (as fixed-width little-endian bytes) and binary
+       exponents of a list of mpf (see _special)."""
+    mans, exps = [], []
+    for x in parts:
+        sign, man, exp, bc = x._mpf_
+        mans.append(-int(man) if sign else int(man))
+        exps.append(exp)
+    width = max([(abs(m).bit_length() + 8)//8 for m in mans] + [1])
+    data = b''.join(m.to_bytes(width, 'little', signed=True) for m in mans)
+    return (np.frombuffer(data, dtype=np.uint8).reshape(len(mans), width),
+            np.array(exps, dtype=np.int64))
+
+
+def _unpack(mant, exp):
+    values = []
+    for (m, e) in zip(mant, exp):
+        m, e = int.from_bytes(m.tobytes(), 'little', signed=True), int(e)
+        if m == 0 and e in _special:
+            values.append(mp.make_mpf(_special[e]))
+        else:
+            values.append(mp.mpf((m, e)))
+    return values
+
+
+class MPArray:
+    """A compact array of mpmath numbers, e.g. to keep many eigenvectors
+    of a high precision sweep (MPArray(QS.Xs)).
+
+    The exact values are stored in contiguous NumPy arrays, as the binary
+    exponents (int64) and the mantissas (fixed-width bytes), separately
+    for the real and, if needed, the imaginary parts. That takes about a
+    quarter of the memory of the mpf objects of an mp.matrix at 50 digits.
+    A double precision copy (MA.values, float64 or complex128) is made
+    once on construction and shared by all the NumPy conversions
+    (np.asarray(MA) returns it without copying).
+
+    MPArray is a storage format, e.g. for the disk cache (see arrays()
+    and fromArrays()), not a working representation: indexing returns
+    mpmath numbers (or MPArrays for slices), and MA.tomatrix() converts
+    1- and 2-dimensional arrays back to mp.matrix for the mpmath linear
+    algebra. Vectorized elementwise work in double precision goes
+    through MA.values."""
+
+    def __init__(self, values):
+        if isinstance(values, MPArray):
+            self.__dict__.update(values.__dict__)
+            return
+        if isinstance(values, mp.matrix):
+            values = values.tolist()
+        values = np.array(values, dtype=object)
+        self.shape = values.shape
+        flat = [mp.mpmathify(x) for x in values.ravel()]
+        re, im = _parts(flat)
+        self._re = _pack(re)
+        self._im = None if im is None else _pack(im)
+        if im is None:
+            self.values = np.array([float(x) for x in re]).reshape(self.shape)
+        else:
+            self.values = np.array([complex(x) for x in flat]).reshape(
+                self.shape)
+        self.values.flags.writeable = False
+
+    @classmethod
+    def _fromParts(cls, shape, re, im, values):
+        MA = cls.__new__(cls)
+        MA.shape, MA._re, MA._im, MA.values = shape, re, im, values
+        MA.values.flags.writeable = False
+        return MA
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def iscomplex(self):
+        return self._im is not None
+
+    @property
+    def nbytes(self):
+        """Memory taken by the exact values (without MA.values)."""
+        return sum(a.nbytes for part in (self._re, self._im)
+                   if part is not None for a in part)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or dtype == self.values.dtype:
+            return self.values.copy() if copy else self.values
+        return self.values.astype(dtype)
+
+    def toobject(self):
+        """Returns the values as a NumPy object array of mpf/mpc."""
+        values = _unpack(*self._re)
+        if self._im is not None:
+            values = [mp.mpc(re, im)
+                      for (re, im) in zip(values, _unpack(*self._im))]
+        flat = np.empty(len(values), dtype=object)
+        flat[:] = values
+        return flat.reshape(self.shape)
+
+    def tolist(self):
+        return self.toobject().tolist()
+
+    def tomatrix(self):
+        """Returns the values as an mp.matrix (a column for 1-dimensional
+           arrays)."""
+        if self.ndim > 2:
+            raise ValueError("Only vectors and matrices convert to mp.matrix")
+        values = self.toobject()
+        if self.ndim < 2:
+            values = values.reshape(-1, 1)
+        M = mp.matrix(*values.shape)
+        for (i, j) in np.ndindex(values.shape):
+            M[i, j] = values[i, j]
+        return M
+
+    def __getitem__(self, index):
+        flat = np.arange(self.size).reshape(self.shape)[index]
+        if np.ndim(flat) == 0:
+            re = _unpack(*(a[[flat]] for a in self._re))[0]
+            if self._im is None:
+                return re
+            return mp.mpc(re, _unpack(*(a[[flat]] for a in self._im))[0])
+        flat = np.asarray(flat)
+        take = flat.ravel()
+        return MPArray._fromParts(
+            flat.shape, tuple(a[take] for a in self._re),
+            None if self._im is None else tuple(a[take] for a in self._im),
+            self.values.ravel()[take].reshape(flat.shape))
+
+    @property
+    def real(self):
+        return MPArray._fromParts(self.shape, self._re, None,
+                                  np.real(self.values))
+
+    def arrays(self):
+        """Returns the storage as a dictionary of NumPy arrays (e.g. for
+           an ArrayCache or np.savez), see fromArrays()."""
+        arrays = {'.shape': np.array(self.shape, dtype=np.int64),
+                  '.mant': self._re[0], '.exp': self._re[1]}
+        if self._im is not None:
+            arrays['.imant'], arrays['.iexp'] = self._im
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        shape = tuple(int(n) for n in arrays['.shape'])
+        re = (np.asarray(arrays['.mant']), np.asarray(arrays['.exp']))
+        im = None
+        if '.imant' in arrays:
+            im = (np.asarray(arrays['.imant']), np.asarray(arrays['.iexp']))
+        if im is None:
+            values = np.array([float(x) for x in _unpack(*re)])
+        else:
+            values = np.array([complex(float(x), float(y)) for (x, y)
+                               in zip(_unpack(*re), _unpack(*im))])
+        return cls._fromParts(shape, re, im, values.reshape(shape))
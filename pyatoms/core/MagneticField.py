@@ -33,6 +33,9 @@ class ZeemanTerm(SetupClass):
 
         self.conv = 1
 
+    def parameters(self):
+        return ('ZeemanTerm', self.conv, self.Bx, self.By, self.Bz)
+
     @setupmethod
     def setBFactor(self, f):
         """The Zeeman term is $f\vec{B}\vec{J}$"""
@@ -0,0 +1,119 @@
+import os
+import pickle
+import multiprocessing
+from mpmath import mp
+
+# State of a worker process, set up once by _initWorker()
+_worker = {}
+
+
+def applyPoint(system, point):
+    """Applies a parameter point to *system*.
+
+    The point is a dictionary that maps the path of a setup method,
+    relative to the system, to its arguments (a tuple, or a single
+    value for one-argument methods). A list of argument tuples calls
+    the method once per tuple. For example
+        {'ZT.setBz': 1e-3,
+         'CF.setCoefficient': [(4, 3, 2.9e-5), (6, 3, -1.9e-6)]}
+    """
+    for path, args in point.items():
+        method = system
+        for name in path.split('.'):
+            method = getattr(method, name)
+        if not isinstance(args, list):
+            args = [args]
+        for a in args:
+            if isinstance(a, tuple):
+                method(*a)
+            else:
+                method(a)
+
+
+def energiesAndTransitions(system):
+    """The default observable: a tuple (Es, J_transitions())."""
+    P = system.J_transitions()  # the eigenvectors first, see QS.Es
+    return system.Es, P
+
+
+def _initWorker(factory, dps, apply, observable):
+    mp.dps = dps
+    _worker['system'] = factory()
+    _worker['apply'] = apply
+    _worker['observable'] = observable
+
+
+def _runChunk(points):
+    system = _worker['system']
+    results = []
+    for point in points:
+        _worker['apply'](system, point)
+        results.append(_worker['observable'](system))
+    return results
+
+
+def _runPickledChunk(points):
+    # mpmath numbers are rounded to the current precision when unpickled,
+    # so the results are sent as bytes and unpickled with the sweep
+    # precision in the main process
+    return pickle.dumps(_runChunk(points), pickle.HIGHEST_PROTOCOL)
+
+
+def _chunks(points, chunksize):
+    chunk = []
+    for point in points:
+        chunk.append(point)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parallelSweep(factory, points, observable=energiesAndTransitions,
+                  workers=None, dps=None, chunksize=1, apply=applyPoint):
+    """parallelSweep(factory, points, observable, workers=None, dps=None)
+    Evaluates *observable(system)* for every parameter point in *points*
+    using a pool of *workers* processes (by default one per CPU).
+
+    Every worker calls *factory()* once, with the mpmath working precision
+    set to *dps* digits (by default the current precision), to build its
+    own system, e.g. a SingleAtom. The points are then applied to that
+    system one after another with *apply(system, point)* (see
+    `applyPoint()` for the default point format), so every point should
+    set all the parameters that vary within the sweep.
+
+    The points are split into consecutive chunks of *chunksize* points,
+    independent of the number of workers, and the results are yielded
+    in the order of *points* as soon as they are available.
+
+    *factory*, *observable* and *apply* have to be picklable, i.e.
+    module-level functions or functools.partial objects.
+    With workers=1 the sweep runs in the current process."""
+    if dps is None:
+        dps = mp.dps
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1:
+        saved = dict(_worker)
+        try:
+            with mp.workdps(dps):
+                _initWorker(factory, dps, apply, observable)
+            for chunk in _chunks(points, chunksize):
+                with mp.workdps(dps):
+                    results = _runChunk(chunk)
+                for result in results:
+                    yield result
+        finally:
+            _worker.clear()
+            _worker.update(saved)
+        return
+
+    with multiprocessing.Pool(workers, _initWorker,
+                              (factory, dps, apply, observable)) as pool:
+        for data in pool.imap(_runPickledChunk, _chunks(points, chunksize)):
+            with mp.workdps(dps):
+                results = pickle.loads(data)
+            for result in results:
+                yield result
@@ -1,9 +1,10 @@
+import os
 import numpy as np
 from mpmath import mp
-import math
-from .Setup import SetupClass, resultmethod
-
-kB = 1/11.604
+from .Setup import SetupClass, resultmethod, instrumented
+from .Backend import getBackend
+from .Cache import ArrayCache, LRUCache, canonical
+from .Thermodynamics import Thermodynamics, kB
 
 
 #def sortedEig(A):
@@ -34,6 +35,12 @@ kB = 1/11.604
 
     #return E, X
 
+# Cache of diagonalization results, see QuantumSystem.setDiskCache().
+# Enabled by setting the PYATOMS_CACHE environment variable to a directory.
+diskCache = (ArrayCache(os.path.join(os.environ['PYATOMS_CACHE'], 'eigh'))
+             if os.environ.get('PYATOMS_CACHE') else None)
+
+
 def get_diag(M):
     imax = min(M.rows, M.cols)
     ans = mp.zeros(imax, 1)
@@ -51,14 +58,134 @@ class QuantumSystem(SetupClass):
        QS.spectrum(). For transitions between various states
        see QS.transitions().
 
+       If the Hamiltonian does not couple certain groups of basis states
+       (see QS._blocks()), every group is diagonalized separately and the
+       label of the group each eigenstate belongs to is available
+       at QS.Ks.
+
+       QS.spectrum() and QS.transitions() restricted to the lowest N
+       states compute only those eigenstates (see QS.makeReady()).
+
+       The eigenvectors are computed on first use: reading only QS.Es
+       (or QS.thermodynamics()) runs an eigenvalue-only solver, which
+       is two to three times faster in high precision. QS.Xs, QS.spectrum(),
+       QS.transitions() etc. then diagonalize again with eigenvectors,
+       whose energies replace the first ones. Call QS.makeReady() first
+       to get both from a single diagonalization.
+
+       The linear algebra is delegated to QS.backend, which is selected
+       per system with the *backend* argument: 'numpy' (LAPACK in double
+       precision, NumPy arrays) or 'mpmath' (arbitrary precision, mpmath
+       matrices). See `Backend.getBackend()` for the default.
+
+       Subclasses that know that their Hamiltonian is real symmetric
+       set QS.real in self._buildH() and store the real part of it
+       (see the backend's real()), so that the diagonalization, the
+       eigenstates and all the products with them are real, which is
+       several times cheaper than the complex arithmetic.
+
+       Systems that describe their Hamiltonian by QS.parameters() keep
+       the results of their last parameter sets in memory, see
+       QS.setMemoryCache(), and can keep their eigenstates in a cache
+       on disk, see QS.setDiskCache().
+
        This is an abstract class. At least the Hamiltonian construction
        self._buildH(), that sets the inner variable self._H
        has to be implemented in a subclass.
        """
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, backend=None):
         SetupClass.__init__(self, parent)
         self.nstates = 0
+        self.backend = getBackend(backend)
+        self.warmstart = False
+        self.real = False
+        self._Xs = None
+        self._wanted = None
+        self._nsolved = 0
+        self._nvalues = 0
+        self._EsView = None
+        self._entry = None
+        self.diskCache = 'default'
+        self.setMemoryCache()
+
+    def setMemoryCache(self, maxsize='default'):
+        """QS.setMemoryCache(maxsize='default')
+        Keeps the results of the last *maxsize* distinct parameter sets
+        (see QS.parameters()) in memory: the energies, the eigenstates
+        and the results derived from them (e.g. JS.Js), so that going
+        back to a recent state, e.g. by moving a slider back and forth,
+        takes no diagonalization. 'default' keeps 8 with the mpmath
+        backend and none with NumPy, whose diagonalizations of these
+        sizes take about as long as the lookup. 0 disables it."""
+        if maxsize == 'default':
+            maxsize = 8 if self.backend.name == 'mpmath' else 0
+        self._memory = LRUCache(maxsize) if maxsize else None
+
+    def setDiskCache(self, cache='default'):
+        """QS.setDiskCache(cache='default')
+        Sets the ArrayCache in which the energies and eigenstates are
+        stored, keyed by the parameters of the Hamiltonian (see
+        QS.parameters()), the backend and its precision, so that
+        the diagonalization is skipped whenever the same system was
+        already solved, also in an earlier session. None disables the
+        cache, 'default' uses the module-level `diskCache`, which is
+        set up by the PYATOMS_CACHE environment variable."""
+        self.diskCache = cache
+
+    def _cache(self):
+        if self.diskCache == 'default':
+            return diskCache
+        return self.diskCache
+
+    def _snapshot(self):
+        """The backend, its precision and QS.parameters(), or None if
+           the system cannot describe its state."""
+        parameters = self.parameters()
+        if parameters is None:
+            return None
+        precision = mp.prec if self.backend.name == 'mpmath' else 53
+        return (self.backend.name, precision, parameters)
+
+    def _cacheKey(self, snapshot, N, vectors=True):
+        """Key of the lowest N eigenstates (or energies, without
+           *vectors*) in the disk cache, or None if they cannot be
+           cached."""
+        if snapshot is None or self._cache() is None:
+            return None
+        name, precision, parameters = snapshot
+        if not vectors:
+            N = (N, 'energies')
+        return canonical((name, precision, N, parameters))
+
+    def setWarmStart(self, warmstart=True, maxiter=10):
+        """QS.setWarmStart(warmstart=True, maxiter=10)
+        In warm-start mode, every diagonalization starts from the
+        eigenstates of the previous one and only refines them
+        (see the backend's eighUpdate()), falling back to a full
+        diagonalization if the refinement does not converge within
+        *maxiter* iterations. This pays off in sweeps with small steps
+        in high precision."""
+        self.warmstart = warmstart
+        self.maxiter = maxiter
+
+    def makeReady(self, N=None, vectors=True):
+        """QS.makeReady(N=None, vectors=True)
+        Ensures that the lowest N eigenstates (by default all of them)
+        are up-to-date. If only some of them are needed, the backend
+        computes just those (see the backend's eighLowest()), which
+        is much faster for a few states in high precision.
+
+        Without *vectors*, only the energies are ensured."""
+        if N is None or N > self.nstates:
+            N = self.nstates
+        if self.ready and (self._nsolved if vectors else self._nvalues) < N:
+            self.ready = False
+        self._wanted = (N, vectors)
+        try:
+            SetupClass.makeReady(self)
+        finally:
+            self._wanted = None
 
     @property
     def H(self):
@@ -68,26 +195,164 @@ class QuantumSystem(SetupClass):
         return self._H
 
     @property
-    @resultmethod
+    @resultmethod(vectors=False)
     def Es(self):
-        return np.real(np.array(self._Es.tolist(), dtype=complex).flatten())
+        """The energies as a (read-only) NumPy array, converted once
+           per diagonalization."""
+        if self._EsView is None:
+            self._EsView = self._view(self._Es)
+        return self._EsView
+
+    def _view(self, values):
+        """Read-only double precision copy of a vector of the backend."""
+        view = np.real(self.backend.tonumpy(values)).flatten()
+        view.flags.writeable = False
+        return view
 
     @property
     @resultmethod
     def Xs(self):
         return self._Xs
 
+    @property
+    @resultmethod
+    def Ks(self):
+        """Labels (good quantum numbers) of the Hamiltonian blocks
+           the eigenstates belong to, or None if the Hamiltonian
+           was diagonalized as a whole."""
+        return self._Ks
+
+    def _blocks(self):
+        """Returns the block structure of the Hamiltonian as a tuple
+           (labels, blocks), where blocks is a list of lists of basis
+           state indices, such that states in different blocks are
+           not coupled, and labels contains a label for every block.
+
+           Returns None if there is no structure to exploit. Subclasses
+           that know the symmetry of their Hamiltonian override this."""
+        return None
+
     def _build(self):
-        """Calculates the energies and eigenstates of the system."""
-        self._Es, self._Xs = mp.eigh(self.H)
+        """Calculates the energies and eigenstates of the system,
+           or takes them from the memory or the disk cache."""
+        N, vectors = self._wanted or (self.nstates, True)
+        self._EsView = None
+        self._entry = None
+        snapshot = None
+        if self._memory is not None or self._cache() is not None:
+            snapshot = self._snapshot()
+        if snapshot is None:
+            self._diagonalize(N, vectors)
+            return
+        self._buildH()  # QS.H stays available with cached states
+
+        memoryKey = None
+        if self._memory is not None:
+            memoryKey = canonical(snapshot)
+            entry = self._memory.get(memoryKey)
+            if entry is not None and \
+                    entry['nsolved' if vectors else 'nvalues'] >= N:
+                self._restore(entry)
+                return
+
+        key = self._cacheKey(snapshot, N, vectors)
+        arrays = None if key is None else self._cache().get(key)
+        if arrays is not None:
+            self._load(arrays)
+        else:
+            self._diagonalize(N, vectors)
+            if key is not None:
+                self._cache().put(key, self._save())
+        if memoryKey is not None:
+            self._memory.put(memoryKey, self._state())
+
+    def _state(self):
+        """The results of the current build as an entry of the memory
+           cache. Subclasses add the results they derive from them to
+           QS._entry, as they compute them."""
+        self._entry = {'Es': self._Es, 'Ks': self._Ks,
+                       'Xs': self._Xs if self._nsolved else None,
+                       'nsolved': self._nsolved, 'nvalues': self._nvalues}
+        return self._entry
+
+    def _restore(self, entry):
+        self._entry = entry
+        self._Es = entry['Es']
+        if entry['nsolved']:
+            self._Xs = entry['Xs']
+        self._Ks = entry['Ks']
+        self._nsolved = entry['nsolved']
+        self._nvalues = entry['nvalues']
+
+    def _save(self):
+        arrays = {'nsolved': np.array(self._nsolved),
+                  'nvalues': np.array(self._nvalues)}
+        results = [('Es', self._Es)]
+        if self._nsolved:
+            results.append(('Xs', self._Xs))
+        for (name, M) in results:
+            for (suffix, a) in self.backend.toArrays(M).items():
+                arrays[name + suffix] = a
+        if self._Ks is not None:
+            arrays['Ks'] = np.asarray(self._Ks)
+        return arrays
+
+    def _load(self, arrays):
+        def part(name):
+            return self.backend.fromArrays(
+                {key[len(name):]: a for (key, a) in arrays.items()
+                 if key.split('.')[0] == name})
+        self._Es = part('Es')
+        self._nsolved = int(arrays['nsolved'])
+        self._nvalues = int(arrays.get('nvalues', self._nsolved))
+        if self._nsolved:
+            self._Xs = part('Xs')
+        self._Ks = np.array(arrays['Ks']) if 'Ks' in arrays else None
+
+    @instrumented
+    def _diagonalize(self, N, vectors=True):
+        """Calculates the lowest N (or more) energies and eigenstates,
+           or only the energies without *vectors* (the eigenstates of
+           an earlier diagonalization are then kept, as results if
+           nothing changed since, otherwise for warm starts)."""
+        unchanged = self._changes is not None and not self._changes
+        structure = self._blocks()
+        self._Ks = None
+        if structure is not None:
+            labels, blocks = structure
+            self._Es, Xs, which = self.backend.eighBlocks(self.H, blocks,
+                                                          vectors)
+            self._Ks = np.array([labels[b] for b in which])
+            N = self.nstates
+        elif N < self.nstates:
+            # the partial solvers find the eigenvectors anyway
+            self._Es, Xs = self.backend.eighLowest(self.H, N)
+            vectors = True
+        elif not vectors:
+            self._Es, Xs = self.backend.eigvalsh(self.H), None
+        else:
+            solution = None
+            if self.warmstart and self._Xs is not None \
+                    and self.backend.size(self._Xs) == self.nstates:
+                solution = self.backend.eighUpdate(self.H, self._Xs,
+                                                   self.maxiter)
+            if solution is None:
+                solution = self.backend.eigh(self.H)
+            self._Es, Xs = solution
+        if vectors:
+            self._Xs = Xs
+            self._nsolved = N
+        elif not unchanged:
+            self._nsolved = 0
+        self._nvalues = N
 
-    @resultmethod
     def spectrum(self, *ops, N=None):
         """QS.spectrum(op1, op2, op3 ..., N=None)
         Calculates expectation values in every eigenstate
         for every operator passed to the function .
 
-        Returns a tuple of NumPy arrays with the expectation values.
+        Returns a tuple of vectors (in the backend representation)
+        with the expectation values.
 
         By default calculates the energies of the eigenstates.
 
@@ -99,7 +364,9 @@ class QuantumSystem(SetupClass):
 
         if ops is None or len(ops) == 0:
             ops = (self.H, )
-        return tuple(get_diag(M)[:N] for M in self.transitions(*ops))
+        self.makeReady(N)
+        X = self.backend.columns(self._Xs, N)
+        return tuple(self.backend.expect(op, X) for op in ops)
 
     def print_spectrum(self, *ops, N=None, prefix="", format='10.3g'):
         """QS.print_spectrum(op1, op2, op3 ..., N=None, prefix='', format='10.3g')
@@ -114,26 +381,41 @@ class QuantumSystem(SetupClass):
         format_line = "{{:{}}}".format(format)
 
         for i in range(N):
-            print(prefix + " ".join(format_line.format(float(M[i])) for M in S))
+            print(prefix + " ".join(format_line.format(float(M[i].real)) for M in S))
 
-    @resultmethod
-    def transitions(self, *ops):
-        """QS.transitions(op1, op2, op3 ...)
+    def transitions(self, *ops, N=None):
+        """QS.transitions(op1, op2, op3 ..., N=None)
         Calculates transition matrix elements for every operator
         passed to the function between every pair of eigenstates.
-        Returns a tuple of NumPy matrices with the expectation values.
+        Returns a tuple of matrices (in the backend representation)
+        with the expectation values.
 
         The initial states span the columns of the matrix, the final states
-        span the rows."""
-        return tuple(self.Xs.H*op*self.Xs for op in ops)
+        span the rows.
+
+        Pass an N to the function to calculate only the elements
+        between the lowest N states."""
+        if N is None or N > self.nstates:
+            N = self.nstates
+
+        self.makeReady(N)
+        X = self.backend.columns(self._Xs, N)
+        return tuple(self.backend.transform(op, X) for op in ops)
+
+    @resultmethod(vectors=False)
+    def thermodynamics(self, T):
+        """QS.thermodynamics(T)
+        Returns the thermodynamics of the system at the temperature(s) *T*
+        (a number or an array), see `Thermodynamics.Thermodynamics`.
+        All temperatures use the same diagonalization."""
+        return Thermodynamics(self.Es, T)
 
     @resultmethod
     def expectBolzmann(self, T, *ops):
         """Calculates the expectation values of arbitrary operators
-        at a finite temperature *T*. Assumes Bolzmann distribution.
+        at a finite temperature *T* (a number or an array).
+        Assumes Bolzmann distribution.
         """
-        Es_corr = self.Es - self.Es[0]  # States ordered by energy
-        Z = sum(math.exp(-e/kB/T) for e in Es_corr)
-        return tuple(
-            sum(v*math.exp(-e/kB/T) for v, e in zip(Vs, Es_corr)) / Z
-            for Vs in self.spectrum(*ops))
+        TH = self.thermodynamics(T)
+        return tuple(TH.average(self.backend.tonumpy(Vs).flatten())
+                     for Vs in self.spectrum(*ops))
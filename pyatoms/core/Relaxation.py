@@ -0,0 +1,214 @@
+import numpy as np
+
+from .Thermodynamics import Thermodynamics, kB
+
+
+def _factor(L):
+    """Gaussian elimination of a stack of generators L (..., n, n) with
+       zero row sums and non-positive off-diagonal elements, without
+       subtractions (Grassmann-Taksar-Heyman): the pivots are taken as
+       the sums of the off-diagonal elements of the reduced rows, which
+       keeps a high relative accuracy however different the rates are.
+       Returns the multipliers (below the diagonal), the pivots (on the
+       diagonal) and the upper triangle in a single array."""
+    L = np.array(L, dtype=float)
+    n = L.shape[-1]
+    for k in range(n-1):
+        pivot = -np.sum(L[..., k, k+1:], axis=-1)
+        L[..., k, k] = pivot
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m = np.where(pivot[..., None] > 0,
+                         L[..., k+1:, k]/pivot[..., None], 0)
+        L[..., k+1:, k+1:] -= m[..., :, None]*L[..., None, k, k+1:]
+        L[..., k+1:, k] = m
+    return L
+
+
+def _solve(LU, b):
+    """Solves L y = b with the factors from _factor(), for a right hand
+       side b with p.b = 0 (p the stationary distribution), fixing the
+       last component of y to zero."""
+    n = LU.shape[-1]
+    b = np.array(b, dtype=float)
+    for k in range(n-1):
+        b[..., k+1:] -= LU[..., k+1:, k]*b[..., k, None]
+    y = np.zeros_like(b)
+    for k in range(n-2, -1, -1):
+        pivot = LU[..., k, k]
+        s = b[..., k] - np.sum(LU[..., k, k+1:]*y[..., k+1:], axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y[..., k] = np.where(pivot > 0, s/pivot, 0)
+    return y
+
+
+class Relaxation:
+    """Relaxation of the populations of the levels (energies *Es* in meV)
+    by incoherent transitions between them, following the master equation
+
+        dp_f/dt = sum_i (W_fi p_i - W_if p_f)
+
+    with the rate W_fi = P_fi*G(E_i - E_f) from state i to state f, where
+    P_fi are transition probabilities, e.g. from JS.J_transitions()
+    or SA.sweep(), and, for the energy w released in the transition,
+
+        G(w) = sum_k c_k w^k/(1 - exp(-w/kB T)).
+
+    Two channels are included: scattering of conduction electrons
+    (k = 1, coefficient *electron*) and one-phonon processes in a Debye
+    model (k = 3, *phonon*), which give the direct and the Orbach rates.
+    The rates obey detailed balance. They are in the units of the
+    coefficients times meV^k (e.g. 1/s for *phonon* in 1/(s meV^3)).
+
+    As for Thermodynamics, Es and P can be single spectra (shapes (n,)
+    and (n, n)) or batches (S+(n,) and S+(n, n)), and *T* any array; all
+    the results have the shape S+T.shape(+(n,)), computed at once.
+
+    Deep in the blocking regime the slowest rate (R.rate, R.tau) is many
+    orders of magnitude below the fastest, far beyond the absolute
+    accuracy of a dense eigensolver. It is therefore refined by inverse
+    iteration with a subtraction-free elimination of the generator,
+    which keeps its relative accuracy (checked against mpmath down to
+    rates 10^-190 of the fastest ones)."""
+
+    def __init__(self, Es, P, T, electron=0, phonon=0, iterations=3):
+        self.thermodynamics = Thermodynamics(Es, T)
+        TH = self.thermodynamics
+        self.T = TH.T
+        self.shape = TH.shape
+        self.nstates = TH.nstates
+        self.iterations = max(iterations, 1)
+
+        P = np.real(np.asarray(P))
+        w = TH._expand(np.asarray(Es, dtype=float))
+        w = w[..., None, :] - w[..., :, None]  # E_i - E_f at [..., f, i]
+        kT = kB*self.T[..., None, None]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            bose = np.where(w != 0, -1/np.expm1(-w/kT), 0)  # 1/(1-e^-w/kT)
+        G = 0
+        for (k, c) in ((1, electron), (3, phonon)):
+            if c:
+                # w^k/(1 - exp(-w/kT)), with the limit kT w^(k-1) at w = 0
+                Gk = np.where(w != 0, w**k*bose, kT if k == 1 else 0)
+                G = G + c*np.nan_to_num(Gk, posinf=0)
+        W = TH._expand(P, 2)*G
+        n = self.nstates
+        W[..., np.arange(n), np.arange(n)] = 0
+        self.W = W
+        self._mode = None
+
+    def matrix(self):
+        """R.matrix()
+        Returns the matrix A of the master equation dp/dt = A p."""
+        A = self.W.copy()
+        n = self.nstates
+        A[..., np.arange(n), np.arange(n)] = -np.sum(self.W, axis=-2)
+        return A
+
+    def _symmetric(self):
+        """The matrix of the master equation in the symmetric form
+           p^(-1/2) A p^(1/2), whose elements are even in E_i - E_f."""
+        p = self.thermodynamics.populations
+        s = np.sqrt(p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            S = self.W*s[..., None, :]/s[..., :, None]
+        S = np.nan_to_num(np.triu(S, 1))
+        S = S + np.swapaxes(S, -1, -2)
+        n = self.nstates
+        S[..., np.arange(n), np.arange(n)] = -np.sum(self.W, axis=-2)
+        return S
+
+    @property
+    def relaxationRates(self):
+        """All the relaxation rates (eigenvalues of -A), ascending,
+        shape S+T.shape+(n,). The first is 0 (equilibrium). Computed by
+        a dense eigensolver, so with an absolute accuracy relative to
+        the fastest rate (see R.rate for the slowest one)."""
+        return -np.linalg.eigvalsh(self._symmetric())[..., ::-1]
+
+    def _slowest(self):
+        if self._mode is not None:
+            return self._mode
+        p = self.thermodynamics.populations
+        S = self._symmetric()
+        u = np.linalg.eigh(S)[1][..., -2]
+
+        # the eigenfunction x = u/sqrt(p) of the backward generator
+        # L x = -A^T x, which is refined by inverse iteration
+        big = p >= 1e-8*np.max(p, axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.where(p > 0, u/np.sqrt(p), 0)
+        limit = np.max(np.where(big, np.abs(x), 0), axis=-1, keepdims=True)
+        x = np.clip(x, -10*limit, 10*limit)
+        # if u vanishes on all the populated levels (exactly 0 on the
+        # ground state, say), start from the ground state against the rest
+        ground = p == np.max(p, axis=-1, keepdims=True)
+        x = np.where(limit > 0, x, np.where(ground, 1.0, -1.0))
+
+        # eliminate from the highest level down to the ground state
+        order = slice(None, None, -1)
+        L = -np.swapaxes(self.matrix(), -1, -2)[..., order, order]
+        LU = _factor(L)
+        pr = p[..., order]
+        x = x[..., order]
+        for iteration in range(self.iterations):
+            b = x - np.sum(pr*x, axis=-1, keepdims=True)
+            y = _solve(LU, b)
+            y = y - np.sum(pr*y, axis=-1, keepdims=True)
+            scale = np.max(np.abs(y), axis=-1, keepdims=True)
+            scale = np.where(scale > 0, scale, 1)
+            # the Rayleigh quotient <b, b>/<b, L^-1 b> (p-weighted),
+            # which needs no differences of nearly equal numbers
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._rate = (np.sum(pr*(b/scale)*b, axis=-1) /
+                              np.sum(pr*b*(y/scale), axis=-1))
+            x = y/scale
+            x = x/np.sqrt(np.sum(pr*x**2, axis=-1, keepdims=True))
+        self._mode = x[..., order]
+        return self._mode
+
+    @property
+    def mode(self):
+        """The slowest mode x (shape S+T.shape+(n,)): the populations
+        relax as p_i (1 + a x_i exp(-t/tau)), normalized to
+        sum_i p_i x_i^2 = 1."""
+        return self._slowest()
+
+    @property
+    def rate(self):
+        """The slowest nonzero relaxation rate 1/tau."""
+        self._slowest()
+        return self._rate
+
+    @property
+    def tau(self):
+        """The relaxation time of the slowest mode."""
+        with np.errstate(divide='ignore'):
+            return 1/self.rate
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class testRelaxation(unittest.TestCase):
+        def test_twoLevels(self):
+            """ the only rate of two levels is W_10 + W_01"""
+            R = Relaxation([0, 1], [[0, 1], [1, 0]], [0.5, 2, 10], phonon=1)
+            W = R.W
+            self.assertTrue(np.allclose(R.rate, W[..., 0, 1] + W[..., 1, 0],
+                                        rtol=1e-12))
+
+        def test_groundNotInDenseMode(self):
+            """ the dense slowest mode can vanish on the ground state, the
+            only populated level, which must not give nan"""
+            from pyatoms.J.SingleAtom import SingleAtom
+            sa = SingleAtom(8, 3, backend='numpy')
+            sa.setDiskCache(None)
+            sa.CF.setSymmetry('C3v')
+            sa.CF.setCoefficients([-0.3, 0, 1e-4, 0, 0, 0])
+            sa.ZT.setBz(0.5)
+            rate = sa.relaxation([0.5, 1, 2, 5], phonon=1, electron=0.1,
+                                 N=6).rate
+            self.assertTrue(np.all(np.isfinite(rate) & (rate > 0)))
+            self.assertAlmostEqual(rate[2]/rate[1], 1, places=6)
+
+    unittest.main()
@@ -1,15 +1,192 @@
+import json
+import time
 from functools import wraps
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Instrumentation:
+    """Statistics of the rebuild graph: for every (class, method),
+    the number of calls, their durations and, for setup methods,
+    the invalidation cascades they caused (the number of nodes that
+    were ready and had to be marked for a rebuild).
+
+    Recorded are the setup, build and result methods (see the decorators
+    in this module), the `_build()` of every node (as run by `makeReady()`)
+    and all the functions decorated by `instrumented()`, e.g. the
+    diagonalizations of the backends and the Stevens operators.
+
+    Instrumentation is off unless enabled with `startInstrumentation()`
+    or the `instrumentation()` context manager."""
+
+    def __init__(self):
+        self.times = {}
+        self.cascades = {}
+        self._invalidated = 0
+
+    def record(self, key, duration):
+        self.times.setdefault(key, []).append(duration)
+
+    def recordCascade(self, key, size):
+        self.cascades.setdefault(key, []).append(size)
+
+    def merge(self, other):
+        """Adds the statistics of another Instrumentation (e.g. from
+           another process, see load())."""
+        for (key, values) in other.times.items():
+            self.times.setdefault(key, []).extend(values)
+        for (key, values) in other.cascades.items():
+            self.cascades.setdefault(key, []).extend(values)
+        return self
+
+    def clear(self):
+        self.times.clear()
+        self.cascades.clear()
+
+    def calls(self, cls, method):
+        """Number of recorded calls of cls.method (class names)."""
+        return len(self.times.get((cls, method), ()))
+
+    def summary(self):
+        """Returns a list of dictionaries with the statistics of every
+           (class, method), sorted by the total time: number of calls,
+           total, mean, median, 90th and 99th percentile and maximum
+           time (in seconds), and the number and mean size of the
+           invalidation cascades."""
+        rows = []
+        for key in set(self.times) | set(self.cascades):
+            t = np.array(self.times.get(key, [0.0]))
+            c = np.array(self.cascades.get(key, [0]))
+            rows.append({
+                'class': key[0], 'method': key[1],
+                'calls': len(self.times.get(key, ())),
+                'total': float(np.sum(t)), 'mean': float(np.mean(t)),
+                'p50': float(np.percentile(t, 50)),
+                'p90': float(np.percentile(t, 90)),
+                'p99': float(np.percentile(t, 99)),
+                'max': float(np.max(t)),
+                'cascades': int(np.count_nonzero(c)),
+                'invalidated': float(np.mean(c))})
+        return sorted(rows, key=lambda r: -r['total'])
+
+    def report(self, file=None):
+        """Prints the summary() as a table."""
+        print("{:>16} {:>20} {:>7} {:>10} {:>10} {:>10} {:>10} {:>8} {:>6}"
+              .format('class', 'method', 'calls', 'total [s]', 'mean',
+                      'p90', 'max', 'cascades', 'nodes'), file=file)
+        for r in self.summary():
+            print("{class:>16} {method:>20} {calls:7d} {total:10.3g} "
+                  "{mean:10.3g} {p90:10.3g} {max:10.3g} {cascades:8d} "
+                  "{invalidated:6.2g}".format(**r), file=file)
+
+    def dump(self, path):
+        """Stores the raw statistics as JSON (see load())."""
+        with open(path, 'w') as f:
+            json.dump({'times': [[k[0], k[1], v]
+                                 for (k, v) in self.times.items()],
+                       'cascades': [[k[0], k[1], v]
+                                    for (k, v) in self.cascades.items()]}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        I = cls()
+        I.times = {(c, m): v for (c, m, v) in data['times']}
+        I.cascades = {(c, m): v for (c, m, v) in data['cascades']}
+        return I
+
+
+# The active Instrumentation, None when disabled.
+_instrumentation = None
+
+
+def startInstrumentation(I=None):
+    """Starts recording into the Instrumentation *I* (a new one
+       by default) and returns it."""
+    global _instrumentation
+    _instrumentation = Instrumentation() if I is None else I
+    return _instrumentation
+
+
+def stopInstrumentation():
+    """Stops recording and returns the statistics."""
+    global _instrumentation
+    I, _instrumentation = _instrumentation, None
+    return I
+
+
+@contextmanager
+def instrumentation(I=None):
+    """with instrumentation() as I: ...
+    Records the statistics of the enclosed code into *I* (a new
+    Instrumentation by default)."""
+    global _instrumentation
+    previous = _instrumentation
+    I = startInstrumentation(I)
+    try:
+        yield I
+    finally:
+        _instrumentation = previous
+
+
+def _key(f, args):
+    """(class, method) of a call: the runtime class for methods of nodes,
+       otherwise the class (or module) where f is defined."""
+    if args and isinstance(args[0], SetupClass):
+        return (type(args[0]).__name__, f.__name__)
+    owner, _, name = f.__qualname__.rpartition('.')
+    return (owner or f.__module__.rpartition('.')[2], name)
+
+
+def _timed(f, key, *ops, **kwops):
+    I = _instrumentation
+    start = time.perf_counter()
+    try:
+        return f(*ops, **kwops)
+    finally:
+        I.record(key, time.perf_counter() - start)
+
+
+def instrumented(f):
+    """Use this decorator for expensive functions and methods (e.g.
+       diagonalizations) that should show up in the Instrumentation.
+       Costs a single check while instrumentation is off."""
+    @wraps(f)
+    def decorated(*ops, **kwops):
+        if _instrumentation is None:
+            return f(*ops, **kwops)
+        return _timed(f, _key(f, ops), *ops, **kwops)
+    return decorated
+
 
 def setupmethod(f):
     """Use this decorator for methods that change the internal state / parameters
        of the system, such that the eigenstates have to be recalculated.
 
-       This method will reset the 'data was changed' flag"""
+       This method will reset the 'data was changed' flag
+       and record the change by the name of the method (see changed())"""
+    name = f.__name__
+
     @wraps(f)
     def decorated(self, *ops, **kwops):
+        I = _instrumentation
+        if I is None:
+            if self.ready:
+                self.makeNotReady(name)
+            elif self._changes is not None:
+                self._changes.add(name)
+            return f(self, *ops, **kwops)
+
+        key = _key(f, (self, ))
+        before = I._invalidated
         if self.ready:
-            self.makeNotReady()
-        return f(self, *ops, **kwops)
+            self.makeNotReady(name)
+        elif self._changes is not None:
+            self._changes.add(name)
+        I.recordCascade(key, I._invalidated - before)
+        return _timed(f, key, self, *ops, **kwops)
     return decorated
 
 
@@ -22,20 +199,35 @@ def buildmethod(f):
     @wraps(f)
     def decorated(self, *ops, **kwops):
         if not self.ready:
-            return f(self, *ops, **kwops)
+            if _instrumentation is None:
+                return f(self, *ops, **kwops)
+            return _timed(f, _key(f, (self, )), self, *ops, **kwops)
     return decorated
 
 
-def resultmethod(f):
+def resultmethod(f=None, **ready):
     """Use this decorator for methods that use the eigenstates to
        calculate their resutls.
 
        This method will make the system ready and set the
-       'data was changed'"""
+       'data was changed'
+
+       Keyword arguments of the decorator are passed on to makeReady(),
+       e.g. @resultmethod(vectors=False) for results of a QuantumSystem
+       that only need the energies."""
+    if f is None:
+        return lambda f: resultmethod(f, **ready)
+
     @wraps(f)
     def decorated(self, *ops, **kwops):
-        self.makeReady()
-        return f(self, *ops, **kwops)
+        if _instrumentation is None:
+            self.makeReady(**ready)
+            return f(self, *ops, **kwops)
+
+        def result():
+            self.makeReady(**ready)
+            return f(self, *ops, **kwops)
+        return _timed(result, _key(f, (self, )))
     return decorated
 
 
@@ -52,23 +244,54 @@ class SetupClass:
 
     Subclasses should implement the `_build()` method that updates
     the object state as necessary based on children state.
+
+    Every node records what changed since its last build: the setup
+    methods called on it and the child nodes that changed. `_build()`
+    can ask `changed()` to update only the affected parts.
     """
     def __init__(self, parent=None):
         self.ready = False
         self.parent = parent
+        self._changes = None  # everything, until the first build
 
     def makeReady(self):
         """Ensures that the object state is up-to-date.
         Will call `_build()` if necessary.
         """
         if not self.ready:
-            self._build()
+            if _instrumentation is None:
+                self._build()
+            else:
+                _timed(self._build, (type(self).__name__, '_build'))
             self.ready = True
+            self._changes = set()
+
+    def parameters(self):
+        """Returns a snapshot of the parameters that define the state
+        of the node (numbers, strings and nested tuples of them), or
+        None if the node cannot describe its state this way. Used as
+        the key of cached results, e.g. by `QuantumSystem`."""
+        return None
+
+    def changed(self, *sources):
+        """SC.changed(*sources)
+        Returns True if any of *sources* (names of setup methods of this
+        node or child nodes) changed since the last build, or if the
+        node was never built."""
+        return self._changes is None or any(s in self._changes
+                                            for s in sources)
 
-    def makeNotReady(self):
+    def makeNotReady(self, source=None):
         """Sets 'update pending' status for this node
-        and all parent nodes.
+        and all parent nodes. *source* is what changed (see changed()),
+        by default everything, the parent nodes record this node.
         """
+        if self.ready and _instrumentation is not None:
+            _instrumentation._invalidated += 1
         self.ready = False
+        if source is None:
+            self._changes = None
+        elif self._changes is not None:
+            self._changes.add(source)
         if self.parent is not None:
-            self.parent.makeNotReady()
+            self.parent.makeNotReady(self)
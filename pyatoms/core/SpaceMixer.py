@@ -4,46 +4,19 @@ from mpmath import mp
 # EVERYTHING WORKS ONLY FOR SQUARE MATRICES !!!
 
 
-def shift_slice(s, n):
-    if s.start is None:
-        return slice(n, s.stop + n, s.step)
-    else:
-        return slice(s.start+n, s.stop + n, s.step)
-
-
-def bloat_slice(s, factor):
-    if s.step is None:
-        if s.start is None:
-            return slice(0, s.stop*factor, factor)
-        else:
-            return slice(s.start,
-                         s.start + (s.stop - s.start) * factor,
-                         factor)
-    else:
-        if s.start is None:
-            return slice(0, s.stop*factor, s.step*factor)
-        else:
-            return slice(s.start,
-                         s.start + (s.stop - s.start) * factor,
-                         s.step*factor)
-
-
-def _expand(op, n, shifts, minor):
-    """
-    op - matrix
-    n x n - size of the result
-    imap - list of lists for mapping
-    """
-    expanded = mp.zeros(n, n, dtype=op.dtype)
-
-    for s in shifts:
-        for j in range(minor):
-            expanded[
-                shift_slice(bloat_slice(slice(op.shape[0]), minor), s+j),
-                shift_slice(bloat_slice(slice(op.shape[1]), minor), s+j)
-                ] = op
-
-    return expanded
+def _factor(op):
+    """Converts a matrix (mpmath, NumPy or nested lists) to a NumPy
+       array. mpmath matrices become object arrays, so that their
+       precision is kept."""
+    if isinstance(op, mp.matrix):
+        return np.array(op.tolist(), dtype=object)
+    return np.array(op)
+
+
+def _nonzero(M):
+    """Returns the COO triplets (rows, cols, values) of M."""
+    rows, cols = np.nonzero(M != 0)
+    return rows, cols, M[rows, cols]
 
 
 def _collect(lists):
@@ -52,12 +25,166 @@ def _collect(lists):
             yield q
 
 
-def _srange(shift, num):
-    for n in range(num):
-        yield shift + n
+class KroneckerOperator:
+    """An operator on the product space of a SpaceMixer, stored lazily
+    as a sum of Kronecker products
+
+        sum_t c_t * (F_t1 x F_t2 x ... x F_tk)
+
+    where every term only keeps the factors F_ti that differ from
+    the identity on their subspace. The full matrix is never formed
+    unless requested with dense(); coo() lists only the nonzero elements
+    and dot() applies the operator to vectors factor by factor.
+
+    Operators can be added, scaled and multiplied (`*` with another
+    KroneckerOperator is the operator product, so e.g. the exchange
+    Jz_1*Jz_2 only stores the two single-spin factors)."""
+
+    # make NumPy arrays defer X @ KO to KO.__rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, dims, terms=()):
+        self.dims = tuple(dims)
+        self.terms = list(terms)
+
+    @property
+    def shape(self):
+        n = int(np.prod(self.dims))
+        return (n, n)
+
+    def _check(self, other):
+        if self.dims != other.dims:
+            raise ValueError("Operators act on different spaces")
+
+    def __add__(self, other):
+        if not isinstance(other, KroneckerOperator):
+            return NotImplemented
+        self._check(other)
+        return KroneckerOperator(self.dims, self.terms + other.terms)
+
+    def __neg__(self):
+        return -1*self
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __mul__(self, other):
+        if isinstance(other, np.ndarray):
+            return NotImplemented
+        if not isinstance(other, KroneckerOperator):
+            return KroneckerOperator(self.dims, [(c*other, F)
+                                                 for (c, F) in self.terms])
+        self._check(other)
+        terms = []
+        for (c1, F1) in self.terms:
+            for (c2, F2) in other.terms:
+                F = dict(F1)
+                for (i, M) in F2.items():
+                    F[i] = F[i].dot(M) if i in F else M
+                terms.append((c1*c2, F))
+        return KroneckerOperator(self.dims, terms)
+
+    def __rmul__(self, other):
+        return KroneckerOperator(self.dims, [(other*c, F)
+                                             for (c, F) in self.terms])
+
+    def __matmul__(self, other):
+        """KO @ KO is the operator product, KO @ X applies KO to the
+           columns of the NumPy array X (see dot())."""
+        if isinstance(other, np.ndarray):
+            return self.dot(other)
+        return self*other
+
+    def __rmatmul__(self, other):
+        """X @ KO for a NumPy array X."""
+        return self.adjoint().dot(np.asarray(other).conj().T).conj().T
+
+    def adjoint(self):
+        """Returns the hermitian conjugate operator."""
+        return KroneckerOperator(self.dims, [
+            (np.conj(c), {i: M.conj().T for (i, M) in F.items()})
+            for (c, F) in self.terms])
+
+    def __truediv__(self, other):
+        return self*(1/other)
+
+    def coo(self):
+        """KO.coo()
+        Returns the nonzero elements as NumPy arrays (rows, cols, values),
+        with duplicate positions summed. The number of elements is
+        bounded by the nonzero elements of the Kronecker factors,
+        independent of the size of the full matrix."""
+        parts = []
+        for (c, F) in self.terms:
+            rows = cols = np.zeros(1, dtype=int)
+            values = np.array([c])
+            for (i, d) in enumerate(self.dims):
+                if i in F:
+                    r, k, v = _nonzero(F[i])
+                else:
+                    r = k = np.arange(d)
+                    v = np.ones(d, dtype=int)
+                rows = (rows[:, None]*d + r).ravel()
+                cols = (cols[:, None]*d + k).ravel()
+                values = (values[:, None]*v).ravel()
+            parts.append((rows, cols, values))
+
+        if not parts or not sum(len(p[0]) for p in parts):
+            return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                    np.zeros(0))
+        rows, cols, values = (np.concatenate(p) for p in zip(*parts))
+        index = rows*self.shape[1] + cols
+        order = np.argsort(index, kind='stable')
+        index, values = index[order], values[order]
+        start = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        values = np.add.reduceat(values, start) if len(values) else values
+        index = index[start]
+        keep = values != 0
+        return (index[keep] // self.shape[1], index[keep] % self.shape[1],
+                values[keep])
+
+    def csr(self):
+        """KO.csr()
+        Returns the operator as a scipy.sparse CSR matrix (needs SciPy;
+        not available for mpmath factors)."""
+        from scipy.sparse import csr_matrix
+        rows, cols, values = self.coo()
+        return csr_matrix((values, (rows, cols)), shape=self.shape)
+
+    def dense(self, backend=None):
+        """KO.dense(backend=None)
+        Returns the full matrix as a NumPy array, or in the representation
+        of *backend* (see Backend.getBackend())."""
+        rows, cols, values = self.coo()
+        M = np.zeros(self.shape, dtype=values.dtype)
+        M[rows, cols] = values
+        if backend is not None:
+            from .Backend import getBackend
+            return getBackend(backend).matrix(M)
+        return M
+
+    def dot(self, x):
+        """KO.dot(x)
+        Applies the operator to a vector, or to the columns of a matrix,
+        given as a NumPy array, without forming the full matrix."""
+        x = np.asarray(x)
+        X = x.reshape(self.dims + (-1,))
+        y = 0
+        for (c, F) in self.terms:
+            Y = X
+            for (i, M) in F.items():
+                Y = np.moveaxis(np.tensordot(M, Y, axes=([1], [i])), 0, i)
+            y = y + c*Y
+        return np.reshape(y, x.shape) if self.terms else 0*x
 
 
 class SpaceMixer:
+    """Combines several subspaces (e.g. spins and nuclei) into their
+    tensor product space. Operators acting on a single subspace are
+    embedded into the product space with convertFromSubspace() as lazy
+    Kronecker products (see KroneckerOperator), which can be combined
+    into couplings between the subspaces, e.g. with dotProduct()."""
+
     def __init__(self):
         self._spaces = []
         self._maps = []
@@ -81,14 +208,40 @@ class SpaceMixer:
         jump = int(np.prod(self._spaces[ssi:]))
         return [i*jump for i in range(elems)]
 
-    def convertFromSubspace(self, ssi, op):
-        """ssi - sub_space_index or tag"""
+    def _index(self, ssi):
         if ssi in self._tags:
             ssi = self._tags[ssi]
-        return _expand(op,
-                       self.size(),
-                       self._maps[ssi],
-                       int(np.prod(self._spaces[ssi+1:])))
+        if not 0 <= ssi < len(self._spaces):
+            raise ValueError("No subspace {}".format(ssi))
+        return ssi
+
+    def identity(self):
+        """Returns the identity operator on the product space."""
+        return KroneckerOperator(self._spaces, [(1, {})])
+
+    def convertFromSubspace(self, ssi, op):
+        """ssi - sub_space_index or tag
+        Returns op (acting on subspace ssi) embedded into the product
+        space, as a KroneckerOperator (use .dense() for the matrix)."""
+        ssi = self._index(ssi)
+        op = _factor(op)
+        if op.shape != (self._spaces[ssi], self._spaces[ssi]):
+            raise ValueError("Operator size does not match subspace {}".
+                             format(ssi))
+        return KroneckerOperator(self._spaces, [(1, {ssi: op})])
+
+    def dotProduct(self, ssi1, ops1, ssi2, ops2):
+        """SM.dotProduct(ssi1, ops1, ssi2, ops2)
+        Returns sum_k ops1[k]*ops2[k] with ops1 acting on subspace ssi1
+        and ops2 on ssi2, e.g. the exchange J_1.J_2 for
+        ops = (Jx, Jy, Jz) of both spins."""
+        if len(ops1) != len(ops2):
+            raise ValueError("Wrong number of operators")
+        result = KroneckerOperator(self._spaces)
+        for (A, B) in zip(ops1, ops2):
+            result = result + (self.convertFromSubspace(ssi1, A) *
+                               self.convertFromSubspace(ssi2, B))
+        return result
 
 
 if __name__ == '__main__':
@@ -96,7 +249,7 @@ if __name__ == '__main__':
 
     class testMixer(unittest.TestCase):
         def setUp(self):
-            self.m1 = mp.matrix('1 2;3 4')
+            self.m1 = mp.matrix([[1, 2], [3, 4]])
             self.x = SpaceMixer()
             self.x.addSubspace(2)
             self.x.addSubspace(2)
@@ -106,11 +259,15 @@ if __name__ == '__main__':
             self.y.addSubspace(4)
 
         def assertEqualMatrices(self, m1, m2, message=None):
-            self.assertTrue((m1 == m2).all(), message)
+            self.assertTrue((np.array(m1.tolist()) ==
+                             np.array(m2.tolist())).all(), message)
 
         def test_expand(self):
             """ make sure the trivial expansion works"""
-            self.assertEqualMatrices(self.m1, _expand(self.m1, 2, [0], 1))
+            z = SpaceMixer()
+            z.addSubspace(2)
+            self.assertEqualMatrices(
+                self.m1, z.convertFromSubspace(0, self.m1).dense())
 
         def test_collect(self):
             self.assertEqual([i for i in _collect([[1],
@@ -128,12 +285,44 @@ if __name__ == '__main__':
 
         def test_convert(self):
             self.assertEqualMatrices(
-                self.x.convertFromSubspace(0, self.m1),
-                mp.matrix('1 0 2 0; 0 1 0 2; 3 0 4 0; 0 3 0 4'),
-                self.x.convertFromSubspace(0, self.m1))
+                self.x.convertFromSubspace(0, self.m1).dense(),
+                mp.matrix([[1, 0, 2, 0], [0, 1, 0, 2],
+                           [3, 0, 4, 0], [0, 3, 0, 4]]),
+                self.x.convertFromSubspace(0, self.m1).dense())
             self.assertEqualMatrices(
-                self.x.convertFromSubspace(1, self.m1),
-                mp.matrix('1 2 0 0; 3 4 0 0; 0 0 1 2; 0 0 3 4'),
+                self.x.convertFromSubspace(1, self.m1).dense(),
+                mp.matrix([[1, 2, 0, 0], [3, 4, 0, 0],
+                           [0, 0, 1, 2], [0, 0, 3, 4]]),
                 "x 1")
 
+        def test_kron(self):
+            A = np.arange(4).reshape(2, 2)
+            B = np.arange(16).reshape(4, 4) % 3
+            AB = (self.y.convertFromSubspace(0, A) *
+                  self.y.convertFromSubspace(2, B))
+            self.assertTrue((AB.dense() ==
+                             np.kron(np.kron(A, np.eye(3)), B)).all())
+            v = np.arange(24.)
+            self.assertTrue(np.allclose(AB.dot(v), AB.dense().dot(v)))
+
+        def test_dot_product(self):
+            S = [np.array([[0, 1], [1, 0]])/2,
+                 np.array([[0, -1j], [1j, 0]])/2,
+                 np.array([[1, 0], [0, -1]])/2]
+            H = self.x.dotProduct(0, S, 1, S).dense()
+            # singlet at -3/4, triplet at 1/4
+            self.assertTrue(np.allclose(np.linalg.eigvalsh(H),
+                                        [-0.75, 0.25, 0.25, 0.25]))
+            self.assertEqual(len(self.x.dotProduct(0, S, 1, S).coo()[0]),
+                             6)
+
+        def test_precision(self):
+            with mp.workdps(40):
+                third = mp.matrix([[mp.mpf(1)/3]])
+                z = SpaceMixer()
+                z.addSubspace(1)
+                z.addSubspace(2)
+                M = z.convertFromSubspace(0, third).dense('mpmath')
+                self.assertEqual(M[1, 1], mp.mpf(1)/3)
+
     unittest.main()
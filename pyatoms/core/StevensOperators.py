@@ -1,6 +1,18 @@
+import os
+from math import comb, gcd
+from fractions import Fraction
+from functools import lru_cache
 import numpy as np
 from mpmath import mp
 from .AngularMomentum import Jrange, Jplus, Jminus, Jx, Jy, Jz
+from .Backend import getBackend
+from .Cache import TieredCache
+from .Setup import instrumented
+
+# Cache of operator matrices used by O(). The on-disk tier is enabled
+# by setting the PYATOMS_CACHE environment variable to a directory,
+# or by calling cache.setDirectory().
+cache = TieredCache(maxsize=1024, directory=os.environ.get('PYATOMS_CACHE'))
 
 
 
@@ -247,14 +259,204 @@ ofuncs = {
     (6,-6):O66s,
     }
 
-def O(J, n, q, no_constant_term=False):
-    if (n, q) in ofuncs:
-        if q == 0:
-            return ofuncs[(n,q)](J, no_constant_term)
+# Closed-form construction
+#
+# For q >= 0 the Stevens operators have the form
+#     O_n^q  = 1/4  [f_nq(Jz), J+^q + J-^q]_+
+#     O_n^-q = 1/4i [f_nq(Jz), J+^q - J-^q]_+
+# (O_n^0 = f_n0(Jz)), where f_nq is a polynomial in Jz and X = J(J+1)
+# with coprime integer coefficients. The matrix elements are then
+#     <m+q|O_n^q|m> = sqrt(<m+q|J+^q|m>^2) (f_nq(m) + f_nq(m+q))/4,
+# so only the diagonals +-q are nonzero and each costs O(2J+1).
+#
+# The polynomials are obtained from the irreducible tensor operators
+# T_n^q, with T_n^n = J+^n and T_n^(q-1) = [J-, T_n^q]. Writing
+# <m+q|T_n^q|m> = sqrt(<m+q|J+^q|m>^2) g_q(m) gives the recursion
+#     g_(q-1)(m) = (X - (m+q-1)(m+q)) g_q(m) - (X - m(m-1)) g_q(m-1)
+# and f_nq follows from f_nq(m) + f_nq(m+q) ~ g_q(m).
+#
+# Polynomials are stored as {(power of m, power of X): coefficient}.
+
+
+def _padd(a, b, factor=1):
+    ans = dict(a)
+    for k, v in b.items():
+        ans[k] = ans.get(k, 0) + factor*v
+    return {k: v for k, v in ans.items() if v != 0}
+
+
+def _pmul(a, b):
+    ans = {}
+    for (am, ax), av in a.items():
+        for (bm, bx), bv in b.items():
+            k = (am+bm, ax+bx)
+            ans[k] = ans.get(k, 0) + av*bv
+    return {k: v for k, v in ans.items() if v != 0}
+
+
+def _pshift(a, s):
+    """Returns the polynomial a(m+s)."""
+    ans = {}
+    for (am, ax), av in a.items():
+        for i in range(am+1):
+            k = (i, ax)
+            ans[k] = ans.get(k, 0) + av*comb(am, i)*s**(am-i)
+    return {k: v for k, v in ans.items() if v != 0}
+
+
+def _peval(a, m, X):
+    return sum(v*m**pm*X**px for (pm, px), v in a.items())
+
+
+@lru_cache(maxsize=None)
+def _fpoly(n, q):
+    """Returns the polynomial f_nq (q >= 0) as a tuple of
+       ((power of m, power of X), integer coefficient)."""
+    m = {(1, 0): 1}
+    X = {(0, 1): 1}
+    g = {(0, 0): 1}
+    for qq in range(n, q, -1):
+        a = _padd(X, _pmul(_pshift(m, qq-1), _pshift(m, qq)), -1)
+        b = _padd(X, _pmul(m, _pshift(m, -1)), -1)
+        g = _padd(_pmul(a, g), _pmul(b, _pshift(g, -1)), -1)
+
+    if q == 0:
+        f = g
+    else:
+        # solve f(m) + f(m+q) = g(m), starting from the highest power of m
+        f = {}
+        for pm in range(max(k[0] for k in g), -1, -1):
+            rest = _padd(g, _padd(f, _pshift(f, q)), -1)
+            f.update({k: Fraction(v, 2) for k, v in rest.items()
+                      if k[0] == pm})
+
+    # normalize to coprime integers with a positive leading coefficient
+    denominator = 1
+    for v in f.values():
+        v = Fraction(v)
+        denominator = denominator*v.denominator//gcd(denominator,
+                                                     v.denominator)
+    f = {k: int(v*denominator) for k, v in f.items()}
+    divisor = 0
+    for v in f.values():
+        divisor = gcd(divisor, v)
+    if f[max(f)] < 0:
+        divisor = -divisor
+    return tuple(sorted((k, v//divisor) for k, v in f.items()))
+
+
+class BandedMatrix:
+    """A square matrix of size *size* stored by its nonzero diagonals.
+
+    BM.bands maps a diagonal offset k to the list of values M[i, i+k]
+    (k > 0 above, k < 0 below the main diagonal)."""
+
+    def __init__(self, size, bands=None):
+        self.size = size
+        self.bands = {} if bands is None else bands
+
+    def dense(self, backend=None):
+        """Returns the full matrix in the representation of *backend*."""
+        backend = getBackend(backend)
+        if backend.name == 'mpmath':
+            M = mp.zeros(self.size)
         else:
-            return ofuncs[(n,q)](J)
+            dtype = complex if any(isinstance(v, mp.mpc)
+                                   for vs in self.bands.values()
+                                   for v in vs) else float
+            M = np.zeros((self.size, self.size), dtype=dtype)
+        for k, vs in self.bands.items():
+            for i, v in enumerate(vs):
+                if k >= 0:
+                    M[i, i+k] = v
+                else:
+                    M[i-k, i] = v
+        return M
+
+
+def _order(n, q):
+    """(n, q) as ints, e.g. from float q = 3.0."""
+    if n != int(n) or q != int(q) or n < 0 or abs(q) > n:
+        raise ValueError("O{}{} does not exist".format(n, q))
+    return int(n), int(q)
+
+
+def banded(J, n, q, no_constant_term=False):
+    """Returns the Stevens operator O_n^q for angular momentum J as
+       a BandedMatrix with mpmath elements (at the current working
+       precision), calculated directly from the closed-form expressions
+       for the matrix elements. Works for any rank n and |q| <= n.
+
+       With *no_constant_term*, the J(J+1)-only terms of O_n^0 are
+       omitted."""
+    n, q = _order(n, q)
+    aq = abs(q)
+    f = _fpoly(n, aq)
+    if q == 0 and no_constant_term:
+        f = tuple((k, v) for k, v in f if k[0] > 0)
+    f = dict(f)
+
+    J = Fraction(J).limit_denominator(2)
+    X = J*(J+1)
+    size = int(2*J+1)
+    ms = [Fraction(i) - J for i in range(size)]
+
+    def value(x):
+        return mp.mpf(x.numerator)/x.denominator
+
+    if q == 0:
+        return BandedMatrix(size, {0: [value(_peval(f, m, X)) for m in ms]})
+
+    lower = []
+    for m in ms[:max(size-aq, 0)]:
+        P2 = 1
+        for i in range(aq):
+            P2 *= (J-m-i)*(J+m+i+1)
+        lower.append(mp.sqrt(value(P2)) *
+                     value(_peval(f, m, X) + _peval(f, m+aq, X))/4)
+
+    if q > 0:
+        upper = lower
     else:
-        raise NotImplementedError("O{}{}".format(n, q))
+        upper = [mp.mpc(0, v) for v in lower]
+        lower = [mp.mpc(0, -v) for v in lower]
+    return BandedMatrix(size, {aq: upper, -aq: lower})
+
+
+@instrumented
+def O(J, n, q, no_constant_term=False, backend=None):
+    """Returns the Stevens operator O_n^q for angular momentum J
+       as a matrix in the representation of *backend*.
+
+       The matrices are built from the closed-form matrix elements
+       (see `banded()`), so any rank n and |q| <= n is supported.
+
+       The matrices are cached by (J, n, q, no_constant_term, backend)
+       and, for the mpmath backend, the working precision.
+       A fresh copy is returned on every call."""
+    backend = getBackend(backend)
+    n, q = _order(n, q)
+    prec = mp.prec if backend.name == 'mpmath' else None
+    key = (float(J), n, q, bool(no_constant_term and q == 0),
+           backend.name, prec)
+
+    op = cache.get(key)
+    if op is None:
+        op = banded(J, n, q, no_constant_term).dense(backend)
+        cache.put(key, op)
+    return op.copy()
+
+
+def fillCache(Jmax=8, ranks=(2, 4, 6), backend=None):
+    """Computes and caches all the operators O_n^q with n in *ranks*
+       for J = 1/2, 1, ... Jmax, e.g. to populate the on-disk cache."""
+    for J2 in range(1, int(2*Jmax)+1):
+        for n in ranks:
+            for q in range(-n, n+1):
+                O(J2/2, n, q, False, backend)
+                if q == 0:
+                    O(J2/2, n, q, True, backend)
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,132 @@
+import numpy as np
+
+kB = 1/11.604  # Boltzmann constant in meV/K
+
+
+class Thermodynamics:
+    """Thermodynamic quantities of a system with energy levels *Es*
+    (in meV) in equilibrium at temperatures *T* (in K).
+
+    *Es* can be a single spectrum (shape (n,)) or a batch of spectra
+    (shape S+(n,), e.g. from SingleAtom.sweep()), and *T* a number or an
+    array of any shape. All the results have the shape S+T.shape, i.e.
+    every spectrum is combined with every temperature, and are computed
+    at once from the energies (kept as TH.Es), without any further
+    diagonalization.
+
+    The Boltzmann weights are evaluated relative to the ground state
+    (log-sum-exp), so nothing overflows or underflows even when the level
+    spacing is many orders of magnitude larger than kB*T."""
+
+    def __init__(self, Es, T):
+        Es = np.asarray(Es, dtype=float)
+        self.Es = Es
+        self.T = np.asarray(T, dtype=float)
+        self.shape = Es.shape[:-1] + self.T.shape
+        self.nstates = Es.shape[-1]
+        if np.any(self.T <= 0):
+            raise ValueError("Temperatures have to be positive")
+
+        self.beta = 1/(kB*self.T)
+        E0 = np.min(Es, axis=-1)
+        self.E0 = self._expand(E0, 0)
+        self._levels = Es - E0[..., None]
+        self._dE = self._expand(self._levels)
+
+        x = -self._scale(self._dE)
+        self._logsum = np.log(np.sum(np.exp(x), axis=-1))
+        self._p = np.exp(x - self._logsum[..., None])
+
+    def _expand(self, values, dims=1):
+        """Inserts axes for the temperatures in an array of per-state
+           values of shape S+(n,) (or of shape S if dims=0)."""
+        values = np.asarray(values)
+        S = values.shape[:values.ndim - dims]
+        return values.reshape(S + (1,)*self.T.ndim + values.shape[len(S):])
+
+    def _scale(self, dE):
+        """Returns beta*dE for per-state energies dE."""
+        return self.beta[..., None]*dE
+
+    @property
+    def logZ(self):
+        """Logarithm of the partition function."""
+        return self._logsum - self.beta*self.E0
+
+    @property
+    def Z(self):
+        """The partition function (overflows easily, see TH.logZ)."""
+        return np.exp(self.logZ)
+
+    @property
+    def populations(self):
+        """Occupation probabilities of the states, shape S+T.shape+(n,)."""
+        return self._p
+
+    def average(self, values):
+        """TH.average(values)
+        Thermal average of per-state *values* (e.g. expectation values
+        from QS.spectrum(), or <Jz> from SA.sweep()) of shape S+(n,)."""
+        return np.sum(self._p*self._expand(values), axis=-1)
+
+    @property
+    def energy(self):
+        """Internal energy (meV)."""
+        return self.E0 + np.sum(self._p*self._dE, axis=-1)
+
+    @property
+    def freeEnergy(self):
+        """Helmholtz free energy (meV)."""
+        return self.E0 - kB*self.T*self._logsum
+
+    @property
+    def entropy(self):
+        """Entropy in units of kB."""
+        return self._logsum + np.sum(self._p*self._scale(self._dE), axis=-1)
+
+    @property
+    def heatCapacity(self):
+        """Heat capacity in units of kB."""
+        x = self._scale(self._dE)
+        mean = np.sum(self._p*x, axis=-1)
+        return np.sum(self._p*x**2, axis=-1) - mean**2
+
+    def susceptibility(self, M):
+        """TH.susceptibility(M)
+        Static (isothermal) susceptibility d<m>/dB of a moment m, given
+        the matrix elements M[..., i, j] = <i|m|j> between the eigenstates
+        (shape S+(n, n), e.g. from QS.transitions()).
+
+        Includes both the Curie term of the populated states and the
+        Van Vleck term of the field-induced mixing:
+            sum_ij |M_ij|^2 (p_j - p_i)/(E_i - E_j) - beta*<m>^2
+        where the degenerate terms are replaced by their limit beta*p_i.
+
+        The terms of well separated levels reduce to the thermal average
+        of the temperature independent 2*sum_j |M_ij|^2/(E_j - E_i), so
+        only the (few) pairs of nearly degenerate levels need to be
+        evaluated for every temperature."""
+        n = self.nstates
+        A = np.abs(np.reshape(M, (-1, n, n)))**2
+        levels = self._levels.reshape(-1, n)
+        p = self._p.reshape(len(levels), -1, n)
+        beta = self.beta.reshape(-1)
+
+        dE = levels[:, None, :] - levels[:, :, None]  # E_j - E_i
+        spread = np.max(levels[:, -1:] - levels[:, :1], initial=1)
+        near = np.abs(dE) <= 1e-6*max(spread, 1)
+
+        VV = np.sum(np.where(near, 0, A/np.where(near, 1, dE)), axis=-1)
+        chi = 2*np.sum(p*VV[:, None, :], axis=-1)
+
+        # nearly degenerate pairs: beta*(p_i + p_j)/2*tanh(x)/x,
+        # with x = beta*|E_i - E_j|/2, including i = j
+        s, i, j = np.nonzero(near)
+        x = np.abs(dE[s, i, j])[:, None]*beta/2
+        with np.errstate(invalid='ignore'):
+            f = np.where(x > 0, np.tanh(x)/x, 1)
+        w = A[s, i, j][:, None]*(p[s, :, i] + p[s, :, j])/2*f
+        chi += beta*np.add.reduceat(w, np.searchsorted(s, np.arange(len(A))))
+
+        mean = self.average(np.real(np.diagonal(M, axis1=-2, axis2=-1)))
+        return chi.reshape(self.shape) - self.beta*mean**2